@@ -30,16 +30,197 @@ import sys
 import traceback
 import codecs
 import glob
+from itertools import izip
+from optparse import OptionParser
 
-from teryt2osm.utils import setup_locale, add_to_list_dict, count_elements
+from teryt2osm.utils import setup_locale, add_to_list_dict
 from teryt2osm.terc import Wojewodztwo, Powiat, Gmina, load_terc, write_wojewodztwa_wiki
 from teryt2osm.simc import SIMC_Place, load_simc, write_wmrodz_wiki
 from teryt2osm.osm_places import OSM_Place, load_osm
+from teryt2osm.pipeline import load_all
+from teryt2osm.parallel_match import match_parallel
+from teryt2osm.incremental import load_state, save_state, restore_state
+from teryt2osm.catalog_db import import_catalogs, open_catalog
+from teryt2osm.catalog_file import write_catalog, open_mapped_catalog
 from teryt2osm.reporting import Reporting
-from teryt2osm.grid import Grid
+from teryt2osm.grid import GridPyramid
+from teryt2osm.spatial import RadiusGrids, RadiusGrid
+from teryt2osm.reverse_index import ReverseIndex
+from teryt2osm.fuzzy import NameIndex
+from teryt2osm.admin_boundaries import load_admin_boundaries
+from teryt2osm.outliers import find_outliers, CellAreas, SquareAreas
+from teryt2osm.outliers import NeighbourhoodAreas
 import xml.etree.cElementTree as ElementTree
 
-def match_names(pass_no, places_to_match, grid = None):
+# grid sizes used by the matching passes and by `refine`
+GRID_SIZES = ((31, 31), (43, 43), (23, 23), (19, 19))
+
+def find_candidates(osm_place, cell = None):
+    """Find the SIMC places of the name and type of an OSM place, not
+    assigned to any OSM place yet, in the powiaty (and, if needed, gminy)
+    of the grid `cell` of the place. The result depends only on
+    the name, type and cell, so it is the same for all the places with
+    the same (name, type, cell) key.
+
+    Return (simc_places, types_found) tuple. `simc_places` is `None`
+    when the name is not in SIMC at all. `types_found` lists types of the
+    places of that name when none is of the right type."""
+    try:
+        matching_simc_places = SIMC_Place.by_name(osm_place.name)
+    except KeyError:
+        return None, None
+    simc_places = SIMC_Place.find(osm_place.name, osm_place.normalized_type)
+    if not simc_places:
+        return [], [ place.type for place in matching_simc_places ]
+    if cell:
+        simc_places = SIMC_Place.find(osm_place.name,
+                            osm_place.normalized_type, cell.powiaty)
+        if len(simc_places) > 1:
+            simc_places = SIMC_Place.find(osm_place.name,
+                        osm_place.normalized_type, cell.powiaty, cell.gminy)
+    return simc_places, None
+
+def match_candidates(pass_no, osm_place, candidates, grid = None, cell = None,
+                                                        reverse_index = None):
+    """Decide the match of an OSM place from its `find_candidates` result.
+    Nothing is modified. Return value is the same as of `match_place`."""
+    messages = []
+    simc_places, types_found = candidates
+    if simc_places is None:
+        messages.append(("not_found", u"%s: nie znaleziono w TERYT" 
+                                                            % (osm_place,)))
+        return "not_found", None, messages
+    if types_found is not None:
+        messages.append(("bad_type", u"%s: nie znalezionow w TERYT"
+                    u" obiektu właściwego typu (%r, znaleziono: %r)" % (
+                        osm_place, osm_place.type, types_found)))
+        return None, None, messages
+
+    if cell and not simc_places:
+        messages.append(("not_found",
+                    u"%s: nie znaleziono w TERYT miejsca"
+                    u" pasującego do komórki %s" % (osm_place, cell)))
+        return None, None, messages
+
+    if len(simc_places) > 1:
+        if grid:
+            messages.append(("ambigous%i" % (pass_no,), 
+                    u"%s z OSM pasuje do wielu obiektów"
+                    u" SIMC w komórce %s: %s" % (osm_place, cell,
+                        u", ".join([str(p) for p in simc_places]))))
+        else:
+            messages.append(("ambigous%i" % (pass_no,), 
+                    u"%s z OSM pasuje do wielu obiektów w SIMC: %s" % (osm_place,
+                        u", ".join([str(p) for p in simc_places]))))
+        return None, None, messages
+    simc_place = simc_places[0]
+
+    # now check if reverse assignment is not ambigous
+    if reverse_index and (cell or not grid):
+        confl_osm_places = reverse_index.conflicts(osm_place, simc_place, cell)
+    else:
+        confl_osm_places = []
+        for place in OSM_Place.by_name(simc_place.name):
+            if place is osm_place:
+                continue
+            if cell and not grid.near(osm_place, place):
+                continue
+            if place.gmina and place.gmina != simc_place.gmina:
+                continue
+            if place.powiat and place.powiat != simc_place.powiat:
+                continue
+            if place.wojewodztwo and place.wojewodztwo != simc_place.wojewodztwo:
+                continue
+            confl_osm_places.append(place)
+
+    if confl_osm_places:
+        messages.append(("ambigous%i" % (pass_no,), 
+                    u"%s z SIMC pasuje do wielu obiektów w OMS: %s" % (simc_place,
+                        ", ".join([str(p) for p in confl_osm_places]))))
+        return None, None, messages
+    
+    if simc_place.osm_place:
+        messages.append(("ambigous%i" % (pass_no,), 
+                u"%s z SIMC ma już przypisany obiekt OSM: %s" % (
+                    simc_place, simc_place.osm_place)))
+
+    return "match", simc_place, messages
+
+def match_place(pass_no, osm_place, grid = None, reverse_index = None):
+    """Find the SIMC place matching an OSM place. Nothing is modified.
+    `reverse_index` is an optional `ReverseIndex` for the grid.
+
+    Return (result, simc_place, messages) tuple. `result` is "match" when
+    `simc_place` was found, "not_found" when the name is not in SIMC at all
+    and `None` otherwise. `messages` is a list of (channel, message) pairs
+    to report for the place."""
+    if osm_place.name is None:
+        return None, None, [("errors", u"%r: brak nazwy" % (osm_place,))]
+    cell = None
+    if grid:
+        try:
+            cell = grid.get_cell(osm_place)
+        except KeyError:
+            pass
+    return match_candidates(pass_no, osm_place,
+                                find_candidates(osm_place, cell),
+                                                grid, cell, reverse_index)
+
+def assign(osm_place, simc_place, reverse_index = None):
+    osm_place.assign_simc(simc_place)
+    simc_place.assign_osm(osm_place)
+    if reverse_index:
+        reverse_index.update(osm_place)
+
+def match_groups(pass_no, places, grid = None, reverse_index = None):
+    """Match places in groups of the same (lower-case name, type, cell)
+    key. The SIMC candidates are looked up once for each group, through
+    the (name, type, powiat/gmina) indexes of `SIMC_Place.find`, so each
+    group is decided as unique (single candidate), ambiguous (many
+    candidates) or missing (no candidates) before the places are checked
+    one by one. Nothing is modified.
+
+    Return dictionary mapping OSM ids to `match_place` results."""
+    reporting = Reporting()
+    results = {}
+    named = []
+    for osm_place in places:
+        if osm_place.name is None:
+            results[osm_place.id] = match_place(pass_no, osm_place, grid,
+                                                            reverse_index)
+            reporting.progress()
+        else:
+            named.append(osm_place)
+    if grid:
+        cells = grid.get_cells(named)
+    else:
+        cells = [None] * len(named)
+    groups = {}
+    for osm_place, cell in izip(named, cells):
+        key = (osm_place.name.lower(), osm_place.normalized_type, id(cell))
+        add_to_list_dict(groups, key, (osm_place, cell))
+    counts = {"unique": 0, "ambiguous": 0, "missing": 0}
+    for group in groups.values():
+        osm_place, cell = group[0]
+        candidates = find_candidates(osm_place, cell)
+        simc_places = candidates[0]
+        if not simc_places:
+            counts["missing"] += 1
+        elif len(simc_places) > 1:
+            counts["ambiguous"] += 1
+        else:
+            counts["unique"] += 1
+        for osm_place, cell in group:
+            results[osm_place.id] = match_candidates(pass_no, osm_place,
+                                candidates, grid, cell, reverse_index)
+            reporting.progress()
+    reporting.output_msg("info", u"Przebieg %i: %i grup nazw,"
+                u" jednoznacznych: %i, niejednoznacznych: %i, bez kandydatów:"
+                u" %i" % (pass_no, len(groups), counts["unique"],
+                                    counts["ambiguous"], counts["missing"]))
+    return results
+
+def match_names(pass_no, places_to_match, grid = None, processes = 1):
     reporting = Reporting()
     places_count = len(places_to_match)
     if grid:
@@ -53,163 +234,225 @@ def match_names(pass_no, places_to_match, grid = None):
     osm_matched = set()
     simc_matched = set()
     places = [ (str(p), p) for p in places_to_match ]
+    if isinstance(grid, RadiusGrid):
+        reverse_index = None
+    else:
+        reverse_index = ReverseIndex(grid)
+    if processes > 1:
+        results = match_parallel(match_place, pass_no,
+                    [p for n, p in places], grid, processes, reverse_index)
+    else:
+        results = match_groups(pass_no, [p for n, p in places], grid,
+                                                            reverse_index)
+    # names of the places matched in this pass; results computed
+    # in advance for places of the same name might be out of date
+    matched_names = set()
     for name, osm_place in places:
-        reporting.progress()
-        if osm_place.name is None:
-            reporting.output_msg("errors", u"%r: brak nazwy" % (osm_place,), osm_place)
-            continue
-
-        # Find matching entry in SIMC
-        try:
-            matching_simc_places = SIMC_Place.by_name(osm_place.name)
-        except KeyError:
-            reporting.output_msg("not_found", u"%s: nie znaleziono w TERYT" 
-                                                    % (osm_place,), osm_place)
+        if osm_place.name is None \
+                        or osm_place.name.lower() not in matched_names:
+            result, simc_place, messages = results[osm_place.id]
+        else:
+            result, simc_place, messages = match_place(pass_no, osm_place,
+                                                    grid, reverse_index)
+        for channel, msg in messages:
+            reporting.output_msg(channel, msg, osm_place)
+        if result == "not_found":
             places_to_match.remove(osm_place)
-            continue
-        simc_places = [place for place in matching_simc_places 
-                                if place.type == osm_place.normalized_type
-                                    and place.osm_place is None]
-        if not simc_places:
-            types_found = [ place.type for place in matching_simc_places ]
-            reporting.output_msg("bad_type", u"%s: nie znalezionow w TERYT"
-                        u" obiektu właściwego typu (%r, znaleziono: %r)" % (
-                            osm_place, osm_place.type, types_found), osm_place)
+        if result != "match":
             continue
 
-        cell = None
-        if grid:
-            try:
-                cell = grid.get_cell(osm_place)
-            except KeyError:
-                pass
-        if cell:
-            simc_places = [ p for p in simc_places if p.powiat in cell.powiaty ]
-            if len(simc_places) > 1:
-                simc_places = [ p for p in simc_places if p.gmina in cell.gminy ]
-            if not simc_places:
-                reporting.output_msg("not_found",
-                        u"%s: nie znaleziono w TERYT miejsca"
-                        u" pasującego do komórki %s" % (osm_place, cell),
-                        osm_place)
-                continue
+        # good match
+        assign(osm_place, simc_place, reverse_index)
 
-        if len(simc_places) > 1:
-            if grid:
-                reporting.output_msg("ambigous%i" % (pass_no,), 
-                        u"%s z OSM pasuje do wielu obiektów"
-                        u" SIMC w komórce %s: %s" % (osm_place, cell,
-                            u", ".join([str(p) for p in simc_places])), 
-                                                                osm_place)
-            else:
-                reporting.output_msg("ambigous%i" % (pass_no,), 
-                        u"%s z OSM pasuje do wielu obiektów w SIMC: %s" % (osm_place,
-                            u", ".join([str(p) for p in simc_places])), osm_place)
-            continue
-        simc_place = simc_places[0]
+        reporting.output_msg("match", u"%s w OSM to %s w SIMC" % (osm_place, simc_place), osm_place) 
+        osm_matched.add(osm_place)
+        simc_matched.add(simc_place)
+        places_to_match.remove(osm_place)
+        matched_names.add(osm_place.name.lower())
 
-        # now check if reverse assignment is not ambigous
-        matching_osm_places = OSM_Place.by_name(simc_place.name)
-        confl_osm_places = []
-        for place in matching_osm_places:
-            if place is osm_place:
-                continue
-            if cell:
-                try:
-                    g_cell = grid.get_cell(place) 
-                except KeyError:
-                    g_cell = None
-                if g_cell is not cell:
-                    continue
-            if place.gmina and place.gmina != simc_place.gmina:
-                continue
-            if place.powiat and place.powiat != simc_place.powiat:
+    reporting.progress_stop()
+    reporting.output_msg("stats", 
+            u"Przebieg %i: znaleziono w SIMC %i z %i miejscowości OSM" % (
+                                    pass_no, len(osm_matched), places_count))
+    return osm_matched, simc_matched
+
+def fuzzy_candidates(osm_place, grid, name_index):
+    """Return (score, simc_place) pairs of SIMC places of names similar
+    to the name of `osm_place`, in the powiaty (and gminy) of its grid
+    cell and in its powiat and gmina, if known. The best matches first."""
+    cell = None
+    try:
+        cell = grid.get_cell(osm_place)
+    except KeyError:
+        pass
+    if cell is None and osm_place.powiat is None:
+        return []
+    result = []
+    for score, name in name_index.find(osm_place.name):
+        if cell:
+            simc_places = SIMC_Place.find(name, osm_place.normalized_type,
+                                                            cell.powiaty)
+            if len(simc_places) > 1:
+                simc_places = SIMC_Place.find(name,
+                        osm_place.normalized_type, cell.powiaty, cell.gminy)
+        else:
+            simc_places = SIMC_Place.find(name, osm_place.normalized_type)
+        for simc_place in simc_places:
+            if osm_place.powiat and simc_place.powiat != osm_place.powiat:
                 continue
-            if place.wojewodztwo and place.wojewodztwo != simc_place.wojewodztwo:
+            if osm_place.gmina and simc_place.gmina != osm_place.gmina:
                 continue
-            confl_osm_places.append(place)
+            result.append((score, simc_place))
+    return result
 
-        if confl_osm_places:
+def match_fuzzy(pass_no, places_to_match, grid, name_index):
+    """Match places which names were not found in SIMC to places of similar
+    names nearby (see `fuzzy_candidates`). A match is accepted only when
+    the best candidate is unique and no other place has the same best
+    candidate."""
+    reporting = Reporting()
+    places = [ p for p in places_to_match if p.name is not None ]
+    places_count = len(places)
+    reporting.progress_start(
+            u"Przybliżone dopasowywanie nazw %i miejsc, przebieg %i,"
+            u" z siatką %s" % (places_count, pass_no, grid), places_count)
+    best = {}
+    by_simc_id = {}
+    for osm_place in places:
+        reporting.progress()
+        candidates = fuzzy_candidates(osm_place, grid, name_index)
+        if not candidates:
+            continue
+        score = candidates[0][0]
+        simc_places = [p for s, p in candidates if s == score]
+        if len(simc_places) > 1:
             reporting.output_msg("ambigous%i" % (pass_no,), 
-                        u"%s z SIMC pasuje do wielu obiektów w OMS: %s" % (simc_place,
-                            ", ".join([str(p) for p in confl_osm_places])), osm_place)
+                    u"%s z OSM jest podobny do wielu obiektów SIMC: %s" % (
+                        osm_place, u", ".join([str(p) for p in simc_places])),
+                                                                    osm_place)
             continue
-        
-        if simc_place.osm_place:
+        best[osm_place] = (score, simc_places[0])
+        add_to_list_dict(by_simc_id, simc_places[0].id, osm_place)
+    osm_matched = set()
+    simc_matched = set()
+    for osm_place in places:
+        if osm_place not in best:
+            continue
+        score, simc_place = best[osm_place]
+        same_simc = by_simc_id[simc_place.id]
+        if len(same_simc) > 1:
             reporting.output_msg("ambigous%i" % (pass_no,), 
-                    u"%s z SIMC ma już przypisany obiekt OSM: %s" % (
-                        simc_place, simc_place.osm_place), osm_place)
-
-        # good match
-        osm_place.assign_simc(simc_place)
-        simc_place.assign_osm(osm_place)
-
-        reporting.output_msg("match", u"%s w OSM to %s w SIMC" % (osm_place, simc_place), osm_place) 
+                    u"%s z SIMC jest podobny do wielu obiektów w OSM: %s" % (
+                        simc_place, u", ".join([str(p) for p in same_simc])),
+                                                                    osm_place)
+            continue
+        assign(osm_place, simc_place)
+        reporting.output_msg("match", u"%s w OSM to %s w SIMC"
+                        u" (podobieństwo nazw %.2f)" % (osm_place, simc_place,
+                                                        score), osm_place)
         osm_matched.add(osm_place)
         simc_matched.add(simc_place)
         places_to_match.remove(osm_place)
-
     reporting.progress_stop()
     reporting.output_msg("stats", 
             u"Przebieg %i: znaleziono w SIMC %i z %i miejscowości OSM" % (
                                     pass_no, len(osm_matched), places_count))
     return osm_matched, simc_matched
 
-def refine(places, reference):
-    """Refine places matches by removing those too far from their neighbours."""
-    grid = Grid(reference, 23, 23)
-    reporting.progress_start(
-            u"Szukanie niepasujących powiązań, przebieg 1", len(places))
-    bad_matches = []
-    for place in places:
-        cell = grid.get_cell(place)
-        if place.simc_place.name == place.powiat.name:
-            if cell.wojewodztwa.count(place.wojewodztwo) < 2:
-                bad_matches.append(place)
-                reporting.output_msg("bad_match", u"Prawdopodobnie źle dopasowany: %s" % (place,), place) 
-        elif cell.powiaty.count(place.powiat) < 2:
-            bad_matches.append(place)
-            reporting.output_msg("bad_match", u"Prawdopodobnie źle dopasowany: %s" % (place,), place) 
-        reporting.progress()
-    reporting.progress_stop()
+def make_grids(places, spatial = False):
+    """Return a `GridPyramid` of the places or, with `spatial`,
+    `RadiusGrids` with neighbourhoods of the same area as the grid cells."""
+    if spatial:
+        return RadiusGrids(places)
+    return GridPyramid(places, GRID_SIZES)
+
+def refine_areas(grids, size, radius = None):
+    """Return areas used by `refine`: squares derived from the given radius,
+    the neighbourhoods of the size×size `RadiusGrid` or the cells
+    of the size×size grid."""
+    if radius:
+        return SquareAreas(radius, grids.places)
+    grid = grids.get(size, size)
+    if isinstance(grid, RadiusGrid):
+        return NeighbourhoodAreas(grid)
+    return CellAreas(grid)
+
+def refine(places, grids, radius = None):
+    """Refine places matches by removing those too far from their neighbours.
+    The neighbours are searched in squares with the area of a circle
+    of the `radius` (in km) or, by default, in the grid cells
+    or neighbourhoods."""
+    places = list(places)
+    bad_matches = find_outliers(places, grids.places,
+                                        refine_areas(grids, 23, radius))
+    for place in bad_matches:
+        reporting.output_msg("bad_match", u"Prawdopodobnie źle dopasowany: %s" % (place,), place) 
     reporting.output_msg("info", u"Znaleziono %i kandydatów do usunięcia" % (len(bad_matches),))
 
-    grid = Grid(reference, 19, 19)
-    reporting.progress_start(
-            u"Szukanie niepasujących powiązań, przebieg 2", len(bad_matches))
-    really_bad_matches = set()
+    if radius:
+        radius = radius * 23 / 19
+    really_bad_matches = set(find_outliers(bad_matches, grids.places,
+                                        refine_areas(grids, 19, radius)))
     for place in bad_matches:
-        cell = grid.get_cell(place)
+        if place not in really_bad_matches:
+            continue
         if place.simc_place.name == place.powiat.name:
-            if cell.wojewodztwa.count(place.wojewodztwo) < 2:
-                really_bad_matches.add(place)
-                reporting.output_msg("really_bad_match", u"Prawdopodobnie źle dopasowany: %s" % (place,), place) 
-        elif cell.powiaty.count(place.powiat) < 2:
-            really_bad_matches.add(place)
+            reporting.output_msg("really_bad_match", u"Prawdopodobnie źle dopasowany: %s" % (place,), place) 
+        else:
             reporting.output_msg("really_bad_match", u"Źle dopasowany: %s" % (place,), place) 
-        reporting.progress()
-    reporting.progress_stop()
     reporting.output_msg("info", u"Znaleziono %i miejsc do usunięcia" % (len(really_bad_matches),))
     good_matches = set(places)
     good_matches -= really_bad_matches
     return good_matches
 
-def match():
+def match(places = None, processes = 1, spatial = False,
+                    refine_radius = None, fuzzy = False, boundaries = None,
+                                                            restored = None):
+    """Match OSM places to SIMC places. If `places` is given only
+    those are matched, other places keep their current assignment.
+    `restored` are the places assigned by `restore_state`.
+    With `processes` > 1 the names are matched in parallel. With `spatial`
+    a `SpatialIndex` is used instead of the fixed grids. `refine_radius`
+    is passed to `refine`. With `fuzzy` the places which names are not
+    in SIMC are matched by similar names in the fourth pass.
+    `boundaries` (`AdminBoundaries`) are used as the grid of the first
+    pass."""
+    if restored is None:
+        restored = set()
     preassigned =  set([p for p in OSM_Place.all() if p.simc_place])
-    assigned = set(preassigned)
+    preassigned -= restored
+    assigned = preassigned | restored
     reporting.output_msg("start", u"%i wstępnie (w danych OSM) przypisanych miejscowości" % (len(preassigned),))
+    if restored:
+        reporting.output_msg("start", u"%i miejscowości przypisanych w poprzednim uruchomieniu" % (len(restored),))
     places_to_match = set([p for p in OSM_Place.all() if not p.simc_place])
-    osm_matched1, simc_matched1 = match_names(1, places_to_match)
+    if places is not None:
+        places_to_match &= places
+    not_matched = set(places_to_match)
+    osm_matched1, simc_matched1 = match_names(1, places_to_match,
+                                                    boundaries, processes)
+    # the names not in SIMC
+    not_found = not_matched - places_to_match - osm_matched1
     assigned |=  osm_matched1
-    grid = Grid(assigned, 31, 31)
-    osm_matched2, simc_matched2 = match_names(2, places_to_match, grid)
+    grids = make_grids(assigned, spatial)
+    grid = grids.get(31, 31)
+    osm_matched2, simc_matched2 = match_names(2, places_to_match, grid,
+                                                    processes)
     assigned |= osm_matched2
-    grid = Grid(assigned, 43, 43)
-    osm_matched3, simc_matched3 = match_names(3, places_to_match, grid)
+    grids.add(osm_matched2)
+    grid = grids.get(43, 43)
+    osm_matched3, simc_matched3 = match_names(3, places_to_match, grid,
+                                                    processes)
     assigned |= osm_matched3
+    grids.add(osm_matched3)
     matched = osm_matched1 | osm_matched2 | osm_matched3
-    matched = refine(matched, assigned)
-    assigned = set(preassigned).union(matched)
+    if fuzzy:
+        grid = grids.get(43, 43)
+        osm_matched4, simc_matched4 = match_fuzzy(4, not_found, grid,
+                                        NameIndex(SIMC_Place.all_names()))
+        matched |= osm_matched4
+    matched = refine(matched, grids, refine_radius)
+    assigned = preassigned | restored | matched
     return assigned
 
 def update(places):
@@ -263,6 +506,42 @@ def write_changes(updated_places, created_by):
 
 
 try:
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option("--columnar", action = "store_true", default = False,
+            help = u"przechowuj katalog SIMC w tablicach kolumn"
+                    u" (mniejsze zużycie pamięci)".encode("utf-8"))
+    parser.add_option("-j", "--jobs", type = "int", default = 1,
+            help = u"liczba procesów używanych do wczytywania danych"
+                    u" i dopasowywania nazw"
+                                                        .encode("utf-8"))
+    parser.add_option("--sqlite", action = "store_true", default = False,
+            help = u"korzystaj z katalogów TERC i SIMC zapisanych w bazie"
+                    u" SQLite (cache/teryt.sqlite)".encode("utf-8"))
+    parser.add_option("--mmap", action = "store_true", default = False,
+            help = u"korzystaj z katalogów TERC i SIMC zapisanych w pliku"
+                    u" binarnym (cache/teryt.catalog), odwzorowanym"
+                    u" w pamięci".encode("utf-8"))
+    parser.add_option("--spatial", action = "store_true", default = False,
+            help = u"porównuj położenie miejsc w promieniu od miejsca"
+                    u" (indeks przestrzenny) zamiast w komórkach"
+                    u" stałej siatki".encode("utf-8"))
+    parser.add_option("--refine-radius", type = "float", metavar = "KM",
+            help = u"szukaj sąsiednich miejsc przy odrzucaniu błędnych"
+                    u" dopasowań w kwadratach o polu koła o promieniu KM"
+                    u" (bok kwadratu to KM·√π) zamiast w komórkach siatki"
+                    u" lub otoczeniach miejsc (--spatial)".encode("utf-8"))
+    parser.add_option("--fuzzy", action = "store_true", default = False,
+            help = u"dopasuj miejsca, których nazw nie ma w SIMC,"
+                    u" do miejsc o podobnych nazwach w tym samym powiecie"
+                    u" lub gminie (czwarty przebieg)".encode("utf-8"))
+    parser.add_option("--boundaries", metavar = "FILE",
+            help = u"plik OSM z granicami województw, powiatów i gmin,"
+                    u" używanymi w pierwszym przebiegu dopasowywania"
+                                                        .encode("utf-8"))
+    parser.add_option("--incremental", action = "store_true", default = False,
+            help = u"dopasuj ponownie tylko miejsca, których dotyczą zmiany"
+                    u" w SIMC od poprzedniego uruchomienia".encode("utf-8"))
+    options, args = parser.parse_args()
     this_dir = os.path.dirname(__file__)
     version = subprocess.Popen(["svnversion", this_dir], stdout = subprocess.PIPE).communicate()[0].strip()
     setup_locale()
@@ -274,6 +553,8 @@ try:
     reporting.config_channel("ambigous1", split_level = 1, quiet = True, mapping = True)
     reporting.config_channel("ambigous2", split_level = 1, quiet = True, mapping = True)
     reporting.config_channel("ambigous3", split_level = 1, mapping = True)
+    if options.fuzzy:
+        reporting.config_channel("ambigous4", split_level = 1, quiet = True, mapping = True)
     reporting.config_channel("match", split_level = 2, quiet = True, mapping = True)
     reporting.config_channel("bad_match", split_level = 1, quiet = True, mapping = True)
     reporting.config_channel("really_bad_match", split_level = 1, quiet = True, mapping = True)
@@ -285,13 +566,49 @@ try:
         if not os.path.exists(os.path.join("data", filename)):
             reporting.output_msg("critical", u"Brakujący plik: %r" % (filename,))
             sys.exit(1)
-    load_terc()
-    write_wojewodztwa_wiki()
-    load_simc()
-    write_wmrodz_wiki()
-    load_osm()
-    assigned = match()
-    updated = update(assigned)
+    if options.sqlite:
+        import_catalogs()
+        open_catalog()
+        write_wojewodztwa_wiki()
+        write_wmrodz_wiki()
+        load_osm()
+    elif options.mmap:
+        write_catalog()
+        open_mapped_catalog()
+        write_wojewodztwa_wiki()
+        write_wmrodz_wiki()
+        load_osm()
+    elif options.jobs > 1:
+        load_all(options.jobs, columnar = options.columnar)
+        write_wojewodztwa_wiki()
+        write_wmrodz_wiki()
+    else:
+        load_terc()
+        write_wojewodztwa_wiki()
+        load_simc(columnar = options.columnar)
+        write_wmrodz_wiki()
+        load_osm()
+    boundaries = None
+    if options.boundaries:
+        boundaries = load_admin_boundaries(options.boundaries)
+    state = None
+    if options.incremental:
+        state = load_state()
+    if state:
+        affected, restored = restore_state(state)
+        assigned = match(affected, options.jobs, options.spatial,
+                    options.refine_radius, options.fuzzy, boundaries,
+                                                                restored)
+        updated = update(assigned & affected)
+    else:
+        assigned = match(processes = options.jobs,
+                                            spatial = options.spatial,
+                                    refine_radius = options.refine_radius,
+                                            fuzzy = options.fuzzy,
+                                            boundaries = boundaries)
+        updated = update(assigned)
+    if options.incremental:
+        save_state(assigned)
     write_changes(updated, u"teryt2osm combine.py v. %s" % (version,))
     reporting.close()
 except Exception,err:
@@ -29,7 +29,7 @@ __version__ = "$Revision$"
 import subprocess
 import sys
 from teryt2osm.reporting import Reporting
-from teryt2osm.utils import setup_locale, add_to_list_dict, count_elements
+from teryt2osm.utils import setup_locale, add_to_list_dict, ProgressFile
 from teryt2osm.osm import OSM_Node
 from teryt2osm.osm_boundary import load_osm_boundary
 import xml.etree.cElementTree as ElementTree
@@ -40,24 +40,32 @@ reporting = Reporting(logging = False)
 
 boundary = load_osm_boundary("data/boundary_poland.osm")
 
-# fast node count
-node_count = count_elements("data/raw_data.osm", "node")
-step = node_count / 100
+stream = ProgressFile("data/raw_data.osm")
+try:
+    reporting.progress_start(u"Ładuję data/raw_data.osm", stream.size)
+    tree = ElementTree.parse(stream)
+    reporting.progress_stop()
+finally:
+    stream.close()
 
-reporting.output_msg("info", u"Ładuję data/raw_data.osm")
-tree = ElementTree.parse("data/raw_data.osm")
-
-reporting.progress_start(u"Filtruję...", node_count)
-node_ids = []
 root = tree.getroot()
+nodes = dict((element, OSM_Node(element))
+                            for element in root if element.tag == 'node')
+reporting.output_msg("info", u"Sprawdzam położenie %i węzłów" % (len(nodes),))
+inside = dict(zip(nodes.keys(), boundary.contains_many(
+            [node.lat for node in nodes.values()],
+            [node.lon for node in nodes.values()])))
+
+reporting.progress_start(u"Filtruję...", len(root))
+node_ids = []
 i = 0
 # use list instead of iterator, so there is not problem with removing items
 for element in root:  
     if element.tag != 'node':
         print >>sys.stderr, "Removing %r element"  % (element.tag,)
     else:
-        node = OSM_Node(element)
-        if node in boundary:
+        node = nodes[element]
+        if inside[element]:
             remove = False
         else:
             remove = True
@@ -77,7 +85,7 @@ for element in root:
 
 reporting.progress_stop()
 
-del root
+del root, nodes, inside
 
 node_ids.sort()
 
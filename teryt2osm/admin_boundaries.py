@@ -0,0 +1,299 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""
+Administrative boundaries of the TERC units.
+
+The boundaries of województwa, powiaty and gminy are kept in a bounding
+box R-tree per level. A point is looked up level by level, only in the
+units of the unit found on the level above. `AdminBoundaries` may be
+used in place of `teryt2osm.grid.Grid`: the 'cell' of a place is the
+smallest unit containing it.
+"""
+
+__version__ = "$Revision$"
+
+import math
+import copy
+from itertools import izip
+from teryt2osm.utils import add_to_list_dict, ProgressFile, iter_elements
+from teryt2osm.terc import Wojewodztwo, Powiat, Gmina
+from teryt2osm.grid import Cell
+from teryt2osm.osm import OSM_Node, OSM_Way
+from teryt2osm.osm_boundary import OSM_Boundary
+from teryt2osm.polygons import RasterMask
+from teryt2osm.reporting import Reporting
+
+# admin_level tag values of the units
+ADMIN_LEVELS = (("4", Wojewodztwo), ("6", Powiat), ("7", Gmina))
+
+# raster mask size of a single unit boundary
+ADMIN_MASK_SIZE = 64
+
+class BBoxTree(object):
+    """R-tree of items with (min_lat, min_lon, max_lat, max_lon) bounding
+    boxes, packed with the Sort-Tile-Recursive method."""
+    NODE_SIZE = 8
+    def __init__(self, entries):
+        nodes = [(bbox, item, None) for bbox, item in entries]
+        while len(nodes) > self.NODE_SIZE:
+            nodes = self._pack(nodes)
+        self.root = nodes
+        self.size = len(entries)
+
+    def _pack(self, nodes):
+        size = self.NODE_SIZE
+        parents_count = (len(nodes) + size - 1) // size
+        slice_size = size * int(math.ceil(math.sqrt(parents_count)))
+        nodes = sorted(nodes, key = lambda n: n[0][0] + n[0][2])
+        parents = []
+        for i in range(0, len(nodes), slice_size):
+            row = sorted(nodes[i:i + slice_size],
+                                        key = lambda n: n[0][1] + n[0][3])
+            for j in range(0, len(row), size):
+                children = row[j:j + size]
+                bbox = (min([c[0][0] for c in children]),
+                            min([c[0][1] for c in children]),
+                            max([c[0][2] for c in children]),
+                            max([c[0][3] for c in children]))
+                parents.append((bbox, None, children))
+        return parents
+
+    def __len__(self):
+        return self.size
+
+    def query(self, lat, lon):
+        """Return items which bounding boxes contain the point."""
+        result = []
+        stack = list(self.root)
+        while stack:
+            bbox, item, children = stack.pop()
+            if not (bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3]):
+                continue
+            if children is None:
+                result.append(item)
+            else:
+                stack.extend(children)
+        return result
+
+class AdminCell(Cell):
+    """TERC units of a place within the boundary of `unit`: the unit,
+    its parents and, for a powiat or a województwo, all of its gminy
+    (and powiaty)."""
+    __slots__ = ("unit",)
+    def __init__(self, level, unit, children):
+        Cell.__init__(self, level, unit.index)
+        self.unit = unit
+        if isinstance(unit, Wojewodztwo):
+            self.wojewodztwa.add(unit)
+        else:
+            self.wojewodztwa.add(unit.wojewodztwo)
+            if isinstance(unit, Powiat):
+                self.powiaty.add(unit)
+        for child in children:
+            self.wojewodztwa.add(child.wojewodztwo)
+            self.powiaty.add(child.powiat)
+            self.gminy.add(child)
+
+    def __unicode__(self):
+        return self.unit.full_name()
+
+class AdminBoundaries(object):
+    """Index of `OSM_Boundary` objects of the TERC units."""
+    def __init__(self, boundaries):
+        """`boundaries` is a list of (unit, boundary) pairs."""
+        self.levels = []
+        for admin_level, cls in ADMIN_LEVELS:
+            entries = [(boundary.geometry.bbox, (unit, boundary))
+                            for unit, boundary in boundaries
+                                if isinstance(unit, cls) and not boundary.open]
+            entries.sort(key = lambda e: e[1][0].index)
+            self.levels.append(BBoxTree(entries))
+        self._gminy = {}
+        for gmina in Gmina.all():
+            add_to_list_dict(self._gminy, gmina.powiat.code, gmina)
+            add_to_list_dict(self._gminy, gmina.wojewodztwo.code, gmina)
+        self._unit_cells = {}
+        self._cells = {}
+
+    def __unicode__(self):
+        return (u"granice administracyjne (%i województw, %i powiatów,"
+                u" %i gmin)" % tuple([len(tree) for tree in self.levels]))
+
+    def _parent_matches(self, unit, parent):
+        if parent is None:
+            return True
+        if isinstance(unit, Powiat):
+            return unit.wojewodztwo is parent
+        return unit.powiat is parent or unit.wojewodztwo is parent
+
+    def locate(self, lat, lon):
+        """Return the smallest unit which boundary contains the point or
+        `None`."""
+        return self.locate_many([lat], [lon])[0]
+
+    def locate_many(self, lats, lons):
+        """Return list of the smallest units containing the points
+        (`None` for points outside of all the boundaries)."""
+        result = [None] * len(lats)
+        for tree in self.levels:
+            by_boundary = {}
+            for i, (lat, lon) in enumerate(izip(lats, lons)):
+                for unit, boundary in tree.query(lat, lon):
+                    if self._parent_matches(unit, result[i]):
+                        add_to_list_dict(by_boundary, unit.index,
+                                                    (i, unit, boundary))
+            for unit_index in sorted(by_boundary):
+                candidates = by_boundary[unit_index]
+                boundary = candidates[0][2]
+                inside = boundary.contains_many(
+                                [lats[i] for i, u, b in candidates],
+                                [lons[i] for i, u, b in candidates])
+                for (i, unit, b), flag in izip(candidates, inside):
+                    if flag and (result[i] is None
+                                    or unit.level != result[i].level):
+                        result[i] = unit
+        return result
+
+    def units(self, place):
+        """Return (województwo, powiat, gmina) of a place, as far as
+        they are known from the boundaries."""
+        unit = self.locate(place.lat, place.lon)
+        if unit is None:
+            return None, None, None
+        elif isinstance(unit, Wojewodztwo):
+            return unit, None, None
+        elif isinstance(unit, Powiat):
+            return unit.wojewodztwo, unit, None
+        return unit.wojewodztwo, unit.powiat, unit
+
+    def _unit_cell(self, unit):
+        key = (unit.level, unit.index)
+        cell = self._unit_cells.get(key)
+        if cell is None:
+            if isinstance(unit, Gmina):
+                cell = AdminCell(2, unit, [unit])
+            elif isinstance(unit, Powiat):
+                cell = AdminCell(1, unit, self._gminy.get(unit.code, []))
+            else:
+                cell = AdminCell(0, unit, self._gminy.get(unit.code, []))
+            self._unit_cells[key] = cell
+        return cell
+
+    def get_cell(self, place):
+        cells = self.get_cells([place])
+        if cells[0] is None:
+            raise KeyError, "place outside of the boundaries"
+        return cells[0]
+
+    def get_cells(self, places):
+        """Return list of cells of the places, `None` for places outside
+        of the boundaries."""
+        missing = [p for p in places if id(p) not in self._cells]
+        if missing:
+            units = self.locate_many([p.lat for p in missing],
+                                                [p.lon for p in missing])
+            for place, unit in izip(missing, units):
+                if unit is None:
+                    self._cells[id(place)] = None
+                else:
+                    self._cells[id(place)] = self._unit_cell(unit)
+        return [self._cells[id(p)] for p in places]
+
+    def near(self, place, other):
+        """Check if two places are in the same unit."""
+        try:
+            return self.get_cell(place) is self.get_cell(other)
+        except KeyError:
+            return False
+
+def boundary_unit(boundary, cls):
+    """Find the TERC unit of class `cls` of a boundary, by the
+    'teryt:terc' tag or by the name."""
+    code = boundary.tags.get("teryt:terc")
+    if code:
+        try:
+            return cls.by_code(code)
+        except KeyError:
+            pass
+    if boundary.name:
+        return cls.try_by_name(boundary.name, True)
+    return None
+
+def load_admin_boundaries(filename):
+    """Load boundary relations of województwa, powiaty and gminy from an
+    OSM file, which must also contain all their ways and nodes. Return
+    `AdminBoundaries`."""
+    reporting = Reporting()
+    nodes = {}
+    ways = {}
+    relations = []
+    levels = dict(ADMIN_LEVELS)
+    stream = ProgressFile(filename)
+    try:
+        reporting.progress_start(u"Ładuję %s" % (filename,), stream.size)
+        for elem in iter_elements(stream, ("node", "way", "relation")):
+            if elem.tag == 'node':
+                node = OSM_Node(elem)
+                nodes[node.id] = node
+            elif elem.tag == 'way':
+                way = OSM_Way(elem)
+                ways[way.id] = way
+            else:
+                tags = dict([(sub.attrib["k"], sub.attrib["v"])
+                                    for sub in elem if sub.tag == 'tag'])
+                if (tags.get("boundary") == "administrative"
+                                    and tags.get("admin_level") in levels):
+                    # the element is released by iter_elements
+                    relations.append((copy.deepcopy(elem),
+                                            levels[tags["admin_level"]]))
+        reporting.progress_stop()
+    finally:
+        stream.close()
+    for way in ways.values():
+        way.add_nodes(nodes)
+    del nodes
+    reporting.output_msg("stats", u"Załadowano %i relacji, %i dróg."
+                                                % (len(relations), len(ways)))
+    reporting.progress_start(u"Przygotowuję granice administracyjne",
+                                                            len(relations))
+    boundaries = []
+    for relation, cls in relations:
+        reporting.progress()
+        try:
+            boundary = OSM_Boundary(relation, None, None, ways)
+        except (ValueError, NotImplementedError), err:
+            reporting.output_msg("errors", u"Relacja %s: %s"
+                                        % (relation.attrib.get("id"), err))
+            continue
+        unit = boundary_unit(boundary, cls)
+        if unit is None:
+            reporting.output_msg("errors", u"Nie znaleziono w TERC jednostki"
+                                            u" dla granicy %r" % (boundary,))
+            continue
+        if boundary.open:
+            reporting.output_msg("errors", u"Otwarta granica: %r"
+                                                            % (boundary,))
+            continue
+        boundary.mask = RasterMask.build(boundary.geometry, ADMIN_MASK_SIZE)
+        boundaries.append((unit, boundary))
+    reporting.progress_stop()
+    index = AdminBoundaries(boundaries)
+    reporting.output_msg("stats", u"Granice: %s" % (index,))
+    return index
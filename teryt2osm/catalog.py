@@ -0,0 +1,107 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Common parts of the stored TERC and SIMC catalogs
+(`teryt2osm.catalog_db` and `teryt2osm.catalog_file`)."""
+
+__version__ = "$Revision$"
+
+from teryt2osm.terc import TERCObject, Wojewodztwo, Powiat, Gmina
+from teryt2osm.simc import SIMC_Place, wmrodz
+from teryt2osm.simc import simc2place_mapping, rm2place_mapping
+from teryt2osm.simc import filter_places
+
+def terc_units():
+    """Return (unit, name) pairs of all the loaded TERC units, to be
+    stored. The names are the ones `_terc_object` expects."""
+    result = []
+    for woj in Wojewodztwo.all():
+        result.append((woj, woj.name))
+    for pow in Powiat.all():
+        if pow.is_capital:
+            result.append((pow, u"st. " + pow.name))
+        else:
+            result.append((pow, pow.name))
+    for gmi in Gmina.all():
+        result.append((gmi, gmi.name))
+    return result
+
+def simc_places():
+    """Return all the loaded SIMC places, to be stored. The catalog order
+    of the places with the same name is kept."""
+    result = []
+    for same_name in SIMC_Place._by_name.values():
+        result += same_name
+    return result
+
+def use_catalog(catalog):
+    """Use a `StoredCatalog` for the TERC and SIMC lookups."""
+    for rm, name in catalog.wmrodz():
+        wmrodz[rm] = name
+        if name in simc2place_mapping:
+            rm2place_mapping[rm] = simc2place_mapping[name]
+    TERCObject.use_database(catalog)
+    SIMC_Place.use_store(catalog)
+    Wojewodztwo.all()
+
+class StoredCatalog(object):
+    """Base of the TERC and SIMC lookups in the stored catalogs.
+
+    Objects are created on the first lookup and kept, so the same
+    object is returned each time."""
+    def __init__(self):
+        self.places = {}
+
+    def _terc_object(self, code, level, name, date):
+        """Return TERC unit of a stored record."""
+        obj = TERCObject._by_code.get(code)
+        if obj is not None:
+            return obj
+        if level == "gmi":
+            return Gmina(name, code[0:2], code[2:4], code[4:6], code[6], date)
+        elif level == "pow":
+            return Powiat(name, code[0:2], code[2:4], date)
+        else:
+            return Wojewodztwo(name, code[0:2], date)
+
+    def _simc_place(self, place_id, parent_id, rm, name, terc_id, date):
+        """Return SIMC place of a stored record. The parent is looked up
+        with `by_id`."""
+        place = self.places.get(place_id)
+        if place is not None:
+            return place
+        place = SIMC_Place(rm, name, terc_id, place_id, parent_id, date,
+                                                            register = False)
+        self.places[place_id] = place
+        if place.parent_id:
+            try:
+                place.parent = self.by_id(place.parent_id)
+            except KeyError:
+                pass
+        return place
+
+    def find(self, name, place_type, powiaty = None, gminy = None):
+        """Return places matching a name and type, not assigned to any OSM
+        place yet, optionally only in given powiaty and gminy."""
+        return filter_places([place for place in self.by_name(name)
+                    if place.type == place_type and place.osm_place is None],
+                                                            powiaty, gminy)
+
+    def link_parents(self):
+        pass
@@ -0,0 +1,265 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""SQLite database with the TERC and SIMC catalogs.
+
+The catalogs are imported once by `import_catalogs`. After
+`open_catalog` the TERC units and SIMC places are read from the database
+when they are looked up, so the whole catalog never needs to be loaded
+into memory."""
+
+__version__ = "$Revision$"
+
+import os
+import sqlite3
+from teryt2osm.snapshot import SNAPSHOT_DIR, file_md5
+from teryt2osm.terc import Wojewodztwo, Powiat, Gmina, load_terc
+from teryt2osm.simc import SIMC_Place, load_simc, wmrodz, rm2place_mapping
+from teryt2osm.catalog import StoredCatalog, use_catalog
+from teryt2osm.catalog import terc_units, simc_places
+from teryt2osm.reporting import Reporting
+
+DATABASE = os.path.join(SNAPSHOT_DIR, "teryt.sqlite")
+SOURCES = ("data/TERC.xml", "data/SIMC.xml", "data/WMRODZ.xml")
+
+SCHEMA = """
+CREATE TABLE sources (
+    filename TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    md5 TEXT
+);
+CREATE TABLE wmrodz (
+    rm TEXT PRIMARY KEY,
+    name TEXT
+);
+CREATE TABLE terc (
+    code TEXT PRIMARY KEY,
+    level TEXT,
+    woj TEXT,
+    pow TEXT,
+    gmi TEXT,
+    rodz TEXT,
+    name TEXT,
+    lname TEXT,
+    date TEXT
+);
+CREATE INDEX terc_lname ON terc (lname, level);
+CREATE TABLE simc (
+    sym TEXT PRIMARY KEY,
+    sympod TEXT,
+    rm TEXT,
+    name TEXT,
+    lname TEXT,
+    terc TEXT,
+    date TEXT
+);
+CREATE INDEX simc_lname ON simc (lname);
+CREATE INDEX simc_rm ON simc (rm);
+CREATE INDEX simc_terc ON simc (terc);
+"""
+
+def _text_factory(value):
+    """Return ASCII strings as `str` and other as `unicode`,
+    just like ElementTree does."""
+    try:
+        value.decode("us-ascii")
+        return value
+    except UnicodeError:
+        return value.decode("utf-8")
+
+def _is_current(connection):
+    try:
+        rows = connection.execute(
+                        "SELECT filename, size, mtime, md5 FROM sources")
+        stored = dict([(r[0], r[1:]) for r in rows])
+    except sqlite3.Error:
+        return False
+    for filename in SOURCES:
+        if filename not in stored:
+            return False
+        size, mtime, md5 = stored[filename]
+        stat = os.stat(filename)
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime != mtime and file_md5(filename) != md5:
+            return False
+    return True
+
+def import_catalogs(filename = DATABASE, use_snapshot = True):
+    """Import TERC, SIMC and WMRODZ catalogs into the database,
+    unless it is already up to date. Return True if the data was imported.
+
+    The catalogs are loaded into memory for the import."""
+    reporting = Reporting()
+    if os.path.exists(filename):
+        connection = sqlite3.connect(filename)
+        try:
+            if _is_current(connection):
+                return False
+        finally:
+            connection.close()
+    load_terc(use_snapshot)
+    load_simc(use_snapshot)
+    reporting.output_msg("info", u"Zapisywanie katalogów w %s" % (filename,))
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_filename = filename + ".tmp"
+    if os.path.exists(tmp_filename):
+        os.unlink(tmp_filename)
+    connection = sqlite3.connect(tmp_filename)
+    try:
+        connection.executescript(SCHEMA)
+        for source in SOURCES:
+            stat = os.stat(source)
+            connection.execute("INSERT INTO sources VALUES (?, ?, ?, ?)",
+                    (source, stat.st_size, stat.st_mtime, file_md5(source)))
+        connection.executemany("INSERT INTO wmrodz VALUES (?, ?)",
+                                                            wmrodz.items())
+        rows = []
+        for unit, name in terc_units():
+            if isinstance(unit, Gmina):
+                rows.append((unit.code, unit.level, unit.woj_code,
+                            unit.pow_code, unit.gmi_code, unit.gmi_type, name,
+                            unit.name.lower(), unit.date))
+            elif isinstance(unit, Powiat):
+                rows.append((unit.code, unit.level, unit.woj_code,
+                            unit.pow_code, None, None, name,
+                            unit.name.lower(), unit.date))
+            else:
+                rows.append((unit.code, unit.level, unit.woj_code, None, None,
+                            None, name, unit.name.lower(), unit.date))
+        connection.executemany(
+                "INSERT INTO terc VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        rows = [(p.id, p.parent_id, p.rm, p.name, p.name.lower(), p.terc_id,
+                                                p.date) for p in simc_places()]
+        connection.executemany(
+                "INSERT INTO simc VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        connection.commit()
+    finally:
+        connection.close()
+    os.rename(tmp_filename, filename)
+    return True
+
+def open_catalog(filename = DATABASE):
+    """Use the catalog database for the TERC and SIMC lookups."""
+    database = CatalogDatabase(filename)
+    use_catalog(database)
+    Reporting().output_msg("stats", u"Baza %s: %i województw, %i powiatów,"
+                u" %i gmin i %i miejscowości" % (filename, Wojewodztwo.count(),
+                    Powiat.count(), Gmina.count(), SIMC_Place.count()))
+    return database
+
+class CatalogDatabase(StoredCatalog):
+    """TERC and SIMC lookups in the SQLite database."""
+    def __init__(self, filename = DATABASE):
+        StoredCatalog.__init__(self)
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.text_factory = _text_factory
+
+    def close(self):
+        self.connection.close()
+
+    def reopen(self):
+        """Open a new connection. To be called in a forked process,
+        which must not use the connection of its parent."""
+        self.connection = sqlite3.connect(self.filename)
+        self.connection.text_factory = _text_factory
+
+    def wmrodz(self):
+        return self.connection.execute("SELECT rm, name FROM wmrodz").fetchall()
+
+    def terc_by_code(self, code):
+        row = self.connection.execute("SELECT code, level, name, date"
+                            " FROM terc WHERE code = ?", (code,)).fetchone()
+        if row is None:
+            raise KeyError, code
+        return self._terc_object(*row)
+
+    def terc_by_name(self, cls, name):
+        rows = self.connection.execute("SELECT code, level, name, date"
+                            " FROM terc WHERE lname = ? AND level = ?",
+                                            (name, cls.level)).fetchall()
+        if not rows:
+            raise KeyError, name
+        return [self._terc_object(*row) for row in rows]
+
+    def terc_all(self, cls):
+        if cls.level:
+            rows = self.connection.execute("SELECT code, level, name, date"
+                            " FROM terc WHERE level = ?", (cls.level,))
+        else:
+            rows = self.connection.execute("SELECT code, level, name, date"
+                                                                " FROM terc")
+        return [self._terc_object(*row) for row in rows]
+
+    def terc_count(self, cls):
+        if cls.level:
+            row = self.connection.execute(
+                    "SELECT count(*) FROM terc WHERE level = ?",
+                                                    (cls.level,)).fetchone()
+        else:
+            row = self.connection.execute("SELECT count(*) FROM terc").fetchone()
+        return row[0]
+
+    def _places(self, where, args):
+        rows = self.connection.execute("SELECT sym, sympod, rm, name, terc,"
+                            " date FROM simc " + where + " ORDER BY rowid", args)
+        return [self._simc_place(*row) for row in rows]
+
+    def by_id(self, place_id):
+        """Return single place identified by a SIMC id."""
+        place = self.places.get(place_id)
+        if place is not None:
+            return place
+        places = self._places("WHERE sym = ?", (place_id,))
+        if not places:
+            raise KeyError, place_id
+        return places[0]
+
+    def by_name(self, name):
+        """Return all places matching a name."""
+        places = self._places("WHERE lname = ?", (name.lower(),))
+        if not places:
+            raise KeyError, name
+        return places
+
+    def all_names(self):
+        """Return lower-case names of all the places, each one once."""
+        return [row[0] for row in
+                    self.connection.execute("SELECT DISTINCT lname FROM simc")]
+
+    def by_type(self, place_type):
+        """Return all places of given type."""
+        rms = [rm for rm, t in rm2place_mapping.items() if t == place_type]
+        if not rms:
+            raise KeyError, place_type
+        places = self._places("WHERE rm IN (%s)" % (",".join("?" * len(rms))),
+                                                                    rms)
+        if not places:
+            raise KeyError, place_type
+        return places
+
+    def count(self):
+        return self.connection.execute("SELECT count(*) FROM simc").fetchone()[0]
+
+    def all(self):
+        return self._places("", ())
@@ -0,0 +1,433 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Packed, memory-mapped TERC and SIMC catalog file.
+
+The file contains fixed-width records, a pool of length-prefixed UTF-8
+strings and sorted index sections. It is opened read-only with `mmap`,
+so processes using the same file share one copy of its pages and opening
+the catalog costs almost nothing.
+
+File layout (all integers little-endian)::
+
+    magic "T2OCAT02"
+    3 x (size, mtime, md5)      source files signatures
+    section count, section table (name, offset, length)
+    sections:
+      strings   string pool: (uint16 length, bytes) entries
+      wmrodz    (rm, name) string offsets
+      terc      TERC records: code, level, name, date
+      terccode  TERC record numbers sorted by code
+      tercname  (lower-case name, record number) sorted by name
+      simc      SIMC records: id, parent id, parent record, gmina record,
+                rm, name, date
+      simcid    SIMC record numbers sorted by id
+      simcname  (lower-case name, record number) sorted by name
+      simcrm    SIMC record numbers sorted by rm
+"""
+
+__version__ = "$Revision$"
+
+import os
+import mmap
+import struct
+from teryt2osm.snapshot import SNAPSHOT_DIR, file_md5
+from teryt2osm.terc import Wojewodztwo, Powiat, Gmina, load_terc
+from teryt2osm.simc import SIMC_Place, load_simc, wmrodz, rm2place_mapping
+from teryt2osm.catalog import StoredCatalog, use_catalog
+from teryt2osm.catalog import terc_units, simc_places
+from teryt2osm.reporting import Reporting
+
+CATALOG_FILE = os.path.join(SNAPSHOT_DIR, "teryt.catalog")
+SOURCES = ("data/TERC.xml", "data/SIMC.xml", "data/WMRODZ.xml")
+
+MAGIC = "T2OCAT02"
+SOURCE = struct.Struct("<qd32s")
+SECTION_COUNT = struct.Struct("<I")
+SECTION = struct.Struct("<8sII")
+STRING_LENGTH = struct.Struct("<H")
+WMRODZ_REC = struct.Struct("<II")
+TERC_REC = struct.Struct("<7s3sII")
+SIMC_REC = struct.Struct("<iiiHxxIII")
+INDEX_REC = struct.Struct("<I")
+NAME_INDEX_REC = struct.Struct("<II")
+
+class CatalogFileError(Exception):
+    pass
+
+class _StringPool(object):
+    def __init__(self):
+        self.data = []
+        self.length = 0
+        self.offsets = {}
+
+    def add(self, value):
+        if value is None:
+            value = u""
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        offset = self.offsets.get(value)
+        if offset is None:
+            offset = self.length
+            self.data.append(STRING_LENGTH.pack(len(value)) + value)
+            self.length += STRING_LENGTH.size + len(value)
+            self.offsets[value] = offset
+        return offset
+
+def _signatures():
+    result = []
+    for filename in SOURCES:
+        stat = os.stat(filename)
+        result.append((stat.st_size, stat.st_mtime, file_md5(filename)))
+    return result
+
+def _read_signatures(data):
+    offset = len(MAGIC)
+    result = []
+    for filename in SOURCES:
+        result.append(SOURCE.unpack_from(data, offset))
+        offset += SOURCE.size
+    return result, offset
+
+def _is_current(filename):
+    stream = open(filename, "rb")
+    try:
+        header = stream.read(len(MAGIC) + SOURCE.size * len(SOURCES))
+    finally:
+        stream.close()
+    if not header.startswith(MAGIC):
+        return False
+    signatures = _read_signatures(header)[0]
+    for source, (size, mtime, md5) in zip(SOURCES, signatures):
+        stat = os.stat(source)
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime != mtime and file_md5(source) != md5:
+            return False
+    return True
+
+def write_catalog(filename = CATALOG_FILE, use_snapshot = True):
+    """Write the catalog file, unless it is up to date.
+    Return True if the file was written.
+
+    The catalogs are loaded into memory for that."""
+    if os.path.exists(filename) and _is_current(filename):
+        return False
+    load_terc(use_snapshot)
+    load_simc(use_snapshot)
+    Reporting().output_msg("info", u"Zapisywanie katalogów w %s"
+                                                            % (filename,))
+    strings = _StringPool()
+
+    wmrodz_data = [WMRODZ_REC.pack(strings.add(rm), strings.add(name))
+                                    for rm, name in sorted(wmrodz.items())]
+
+    terc_objects = terc_units()
+    terc_objects.sort(key = lambda x: x[0].code)
+    terc_index = {}
+    terc_data = []
+    terc_names = []
+    for i, (obj, name) in enumerate(terc_objects):
+        terc_index[obj.code] = i
+        terc_data.append(TERC_REC.pack(obj.code, obj.level,
+                                strings.add(name), strings.add(obj.date)))
+        terc_names.append((obj.name.lower().encode("utf-8"), i))
+    terc_names.sort()
+    terc_name_data = [NAME_INDEX_REC.pack(strings.add(n), i)
+                                                    for n, i in terc_names]
+    terc_code_data = [INDEX_REC.pack(i) for i in range(len(terc_objects))]
+
+    places = simc_places()
+    simc_index = dict([(p.id, i) for i, p in enumerate(places)])
+    simc_data = []
+    simc_names = []
+    for i, place in enumerate(places):
+        if place.parent_id:
+            parent_id = int(place.parent_id)
+            parent = simc_index.get(place.parent_id, -1)
+        else:
+            parent_id = 0
+            parent = -1
+        simc_data.append(SIMC_REC.pack(int(place.id), parent_id, parent,
+                                terc_index[place.terc_id], strings.add(place.rm),
+                                strings.add(place.name), strings.add(place.date)))
+        simc_names.append((place.name.lower().encode("utf-8"), i))
+    simc_names.sort()
+    simc_name_data = [NAME_INDEX_REC.pack(strings.add(n), i)
+                                                    for n, i in simc_names]
+    order = range(len(places))
+    order.sort(key = lambda i: int(places[i].id))
+    simc_id_data = [INDEX_REC.pack(i) for i in order]
+    order = range(len(places))
+    order.sort(key = lambda i: places[i].rm)
+    simc_rm_data = [INDEX_REC.pack(i) for i in order]
+
+    sections = [
+            ("strings", strings.data, strings.length),
+            ("wmrodz", wmrodz_data, len(wmrodz_data)),
+            ("terc", terc_data, len(terc_data)),
+            ("terccode", terc_code_data, len(terc_code_data)),
+            ("tercname", terc_name_data, len(terc_name_data)),
+            ("simc", simc_data, len(simc_data)),
+            ("simcid", simc_id_data, len(simc_id_data)),
+            ("simcname", simc_name_data, len(simc_name_data)),
+            ("simcrm", simc_rm_data, len(simc_rm_data)),
+            ]
+    header = MAGIC + "".join([SOURCE.pack(*s) for s in _signatures()])
+    header += SECTION_COUNT.pack(len(sections))
+    offset = len(header) + SECTION.size * len(sections)
+    table = []
+    for name, data, length in sections:
+        table.append(SECTION.pack(name, offset, length))
+        offset += sum([len(d) for d in data])
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmp_filename = filename + ".tmp"
+    stream = open(tmp_filename, "wb")
+    try:
+        stream.write(header)
+        stream.write("".join(table))
+        for name, data, length in sections:
+            stream.write("".join(data))
+    finally:
+        stream.close()
+    os.rename(tmp_filename, filename)
+    return True
+
+def open_mapped_catalog(filename = CATALOG_FILE):
+    """Use the memory-mapped catalog file for the TERC and SIMC lookups."""
+    catalog = MappedCatalog(filename)
+    use_catalog(catalog)
+    Reporting().output_msg("stats", u"Katalog %s: %i województw,"
+                u" %i powiatów, %i gmin i %i miejscowości" % (filename,
+                    Wojewodztwo.count(), Powiat.count(), Gmina.count(),
+                    SIMC_Place.count()))
+    return catalog
+
+class MappedCatalog(StoredCatalog):
+    """TERC and SIMC lookups in a memory-mapped catalog file."""
+    def __init__(self, filename = CATALOG_FILE):
+        StoredCatalog.__init__(self)
+        self.file = open(filename, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise CatalogFileError, "Not a catalog file: %r" % (filename,)
+        offset = _read_signatures(self.data)[1]
+        count = SECTION_COUNT.unpack_from(self.data, offset)[0]
+        offset += SECTION_COUNT.size
+        self.sections = {}
+        for i in range(count):
+            name, start, length = SECTION.unpack_from(self.data, offset)
+            self.sections[name.rstrip("\0")] = (start, length)
+            offset += SECTION.size
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def _string_bytes(self, offset):
+        start = self.sections["strings"][0] + offset
+        length = STRING_LENGTH.unpack_from(self.data, start)[0]
+        start += STRING_LENGTH.size
+        return self.data[start:start + length]
+
+    def _string(self, offset):
+        value = self._string_bytes(offset)
+        try:
+            value.decode("us-ascii")
+            return value
+        except UnicodeError:
+            return value.decode("utf-8")
+
+    def _record(self, section, record_struct, index):
+        start, length = self.sections[section]
+        if index < 0 or index >= length:
+            raise IndexError, index
+        return record_struct.unpack_from(self.data,
+                                            start + index * record_struct.size)
+
+    def _name_range(self, section, name):
+        """Return record numbers for a lower-case name from a name index."""
+        name = name.encode("utf-8")
+        length = self.sections[section][1]
+        low, high = 0, length
+        while low < high:
+            middle = (low + high) // 2
+            key = self._string_bytes(
+                        self._record(section, NAME_INDEX_REC, middle)[0])
+            if key < name:
+                low = middle + 1
+            else:
+                high = middle
+        result = []
+        while low < length:
+            key_offset, index = self._record(section, NAME_INDEX_REC, low)
+            if self._string_bytes(key_offset) != name:
+                break
+            result.append(index)
+            low += 1
+        return result
+
+    def _lower_bound(self, section, key_func, key):
+        """Return position of the first record number in a sorted index
+        section with the key not less than `key`."""
+        length = self.sections[section][1]
+        low, high = 0, length
+        while low < high:
+            middle = (low + high) // 2
+            index = self._record(section, INDEX_REC, middle)[0]
+            if key_func(index) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _search(self, section, key_func, key):
+        """Find record number in a sorted index section."""
+        position = self._lower_bound(section, key_func, key)
+        if position < self.sections[section][1]:
+            index = self._record(section, INDEX_REC, position)[0]
+            if key_func(index) == key:
+                return index
+        return None
+
+    def _range(self, section, key_func, key):
+        """Return all record numbers with the key in a sorted index
+        section."""
+        length = self.sections[section][1]
+        position = self._lower_bound(section, key_func, key)
+        result = []
+        while position < length:
+            index = self._record(section, INDEX_REC, position)[0]
+            if key_func(index) != key:
+                break
+            result.append(index)
+            position += 1
+        return result
+
+    def wmrodz(self):
+        return [(self._string(rm), self._string(name)) for rm, name in
+                [self._record("wmrodz", WMRODZ_REC, i)
+                        for i in range(self.sections["wmrodz"][1])]]
+
+    def _terc_unit(self, index):
+        code, level, name, date = self._record("terc", TERC_REC, index)
+        return self._terc_object(code.rstrip("\0"), level,
+                                        self._string(name), self._string(date))
+
+    def _terc_code(self, index):
+        return self._record("terc", TERC_REC, index)[0].rstrip("\0")
+
+    def terc_by_code(self, code):
+        index = self._search("terccode", self._terc_code, str(code))
+        if index is None:
+            raise KeyError, code
+        return self._terc_unit(index)
+
+    def terc_by_name(self, cls, name):
+        result = []
+        for index in self._name_range("tercname", name):
+            if self._record("terc", TERC_REC, index)[1] == cls.level:
+                result.append(index)
+        if not result:
+            raise KeyError, name
+        result.sort()
+        return [self._terc_unit(index) for index in result]
+
+    def _terc_indexes(self, cls):
+        for index in range(self.sections["terc"][1]):
+            if not cls.level or self._record("terc", TERC_REC, index)[1] == cls.level:
+                yield index
+
+    def terc_all(self, cls):
+        return [self._terc_unit(index) for index in self._terc_indexes(cls)]
+
+    def terc_count(self, cls):
+        return len(list(self._terc_indexes(cls)))
+
+    def _place(self, index):
+        (place_id, parent_id, parent, gmina, rm, name,
+                            date) = self._record("simc", SIMC_REC, index)
+        place_id = "%07i" % (place_id,)
+        place = self.places.get(place_id)
+        if place is not None:
+            return place
+        if parent_id:
+            parent_id = "%07i" % (parent_id,)
+        else:
+            parent_id = None
+        return self._simc_place(place_id, parent_id, self._string(rm),
+                            self._string(name), self._terc_code(gmina),
+                            self._string(date))
+
+    def _simc_id(self, index):
+        return self._record("simc", SIMC_REC, index)[0]
+
+    def by_id(self, place_id):
+        """Return single place identified by a SIMC id."""
+        place = self.places.get(place_id)
+        if place is not None:
+            return place
+        try:
+            index = self._search("simcid", self._simc_id, int(place_id))
+        except ValueError:
+            index = None
+        if index is None:
+            raise KeyError, place_id
+        return self._place(index)
+
+    def by_name(self, name):
+        """Return all places matching a name."""
+        indexes = self._name_range("simcname", name.lower())
+        if not indexes:
+            raise KeyError, name
+        return [self._place(index) for index in indexes]
+
+    def all_names(self):
+        """Return lower-case names of all the places, each one once."""
+        result = []
+        last = None
+        for i in range(self.sections["simcname"][1]):
+            offset = self._record("simcname", NAME_INDEX_REC, i)[0]
+            if offset != last:
+                result.append(self._string(offset))
+                last = offset
+        return result
+
+    def _simc_rm(self, index):
+        return self._string_bytes(self._record("simc", SIMC_REC, index)[4])
+
+    def by_type(self, place_type):
+        """Return all places of given type."""
+        indexes = []
+        for rm, rm_type in rm2place_mapping.items():
+            if rm_type == place_type:
+                indexes += self._range("simcrm", self._simc_rm, rm)
+        if not indexes:
+            raise KeyError, place_type
+        indexes.sort()
+        return [self._place(index) for index in indexes]
+
+    def count(self):
+        return self.sections["simc"][1]
+
+    def all(self):
+        return [self._place(index) for index in range(self.count())]
@@ -0,0 +1,112 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""
+Approximate place name lookup.
+
+The names are normalized (case, diacritics, punctuation, common
+abbreviations) and compared by the Dice coefficient of their sets
+of character trigrams. `NameIndex` keeps the trigram posting lists,
+so only the names sharing one of the rarest trigrams of the query
+are compared with it.
+"""
+
+__version__ = "$Revision$"
+
+import re
+import math
+import unicodedata
+from operator import itemgetter
+from teryt2osm.utils import add_to_list_dict
+from teryt2osm.reporting import Reporting
+
+# lowest similarity of names considered matching
+MIN_SCORE = 0.8
+
+ABBREVIATIONS = {
+        u"kol": u"kolonia",
+        u"os": u"osiedle",
+        u"k": u"kolo",
+        u"n": u"nad",
+        }
+
+_separators_re = re.compile(u"[\\s\\-.,;()\"']+", re.UNICODE)
+
+def normalize_name(name):
+    """Return the name in lower case, without diacritics, punctuation
+    and spaces and with the abbreviations expanded."""
+    name = unicode(name).lower().replace(u"ł", u"l")
+    name = u"".join([c for c in unicodedata.normalize("NFKD", name)
+                                            if not unicodedata.combining(c)])
+    words = _separators_re.split(name)
+    return u"".join([ABBREVIATIONS.get(w, w) for w in words if w])
+
+def trigrams(key):
+    """Return the set of trigrams of a normalized name."""
+    key = u" %s " % (key,)
+    return frozenset([key[i:i + 3] for i in range(len(key) - 2)])
+
+class NameIndex(object):
+    """Trigram index of names."""
+    def __init__(self, names):
+        reporting = Reporting()
+        names = list(names)
+        reporting.progress_start(u"Creating trigram index of %i names"
+                                                % (len(names),), len(names))
+        by_key = {}
+        for name in names:
+            reporting.progress()
+            add_to_list_dict(by_key, normalize_name(name), name)
+        self.keys = by_key.keys()
+        self.names = [by_key[key] for key in self.keys]
+        self.grams = [trigrams(key) for key in self.keys]
+        self.postings = {}
+        for i, grams in enumerate(self.grams):
+            for gram in grams:
+                add_to_list_dict(self.postings, gram, i)
+        reporting.progress_stop()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, name, min_score = MIN_SCORE):
+        """Return (score, name) pairs of the indexed names similar to
+        `name`, the most similar first. The score is 1.0 for names equal
+        after normalization."""
+        grams = trigrams(normalize_name(name))
+        size = len(grams)
+        min_size = int(math.ceil(min_score * size / (2 - min_score) - 1e-9))
+        max_size = int(math.floor((2 - min_score) * size / min_score + 1e-9))
+        min_common = int(math.ceil(min_score * (size + min_size) / 2 - 1e-9))
+        # a name sharing at least `min_common` trigrams with the query
+        # shares one of its `size - min_common + 1` rarest trigrams
+        rarest = sorted(grams, key = lambda g: len(self.postings.get(g, ())))
+        candidates = set()
+        for gram in rarest[:size - min_common + 1]:
+            candidates.update(self.postings.get(gram, ()))
+        result = []
+        for i in candidates:
+            other = self.grams[i]
+            if not min_size <= len(other) <= max_size:
+                continue
+            score = 2.0 * len(grams & other) / (size + len(other))
+            if score >= min_score:
+                result += [(score, n) for n in self.names[i]]
+        result.sort(key = itemgetter(0), reverse = True)
+        return result
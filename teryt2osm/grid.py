@@ -21,34 +21,72 @@
 Grid for optimized place matching.
 """
 
+from itertools import izip
+from array import array
 from teryt2osm.reporting import Reporting
 
 __version__ = "$Revision: 2 $"
 
+try:
+    import numpy
+    HAVE_NUMPY=True
+except ImportError:
+    HAVE_NUMPY=False
+
+# place attributes counted in the cells and the cell attributes
+# keeping the counts
+CELL_LOCATIONS = (("wojewodztwo", "wojewodztwa"), ("powiat", "powiaty"),
+                                                        ("gmina", "gminy"))
+
+NO_LOCATION = -1
+
+def location_index(location):
+    """Return index of a TERC unit or `NO_LOCATION` for `None`."""
+    if location is None:
+        return NO_LOCATION
+    return location.index
+
 class LocationSet(object):
+    """Counts of TERC units of a single level. Units are identified
+    by their indices and kept in two short arrays."""
+    __slots__ = ("indices", "counts")
     def __init__(self):
-        self.dict = {}
+        self.indices = array("i")
+        self.counts = array("I")
 
     def add(self, location):
-        loc_id = id(location)
-        self.dict[loc_id] = self.dict.get(loc_id, 0) + 1
+        self.add_index(location_index(location))
+
+    def add_index(self, index, count = 1):
+        """Add `count` occurences of a unit given by its index."""
+        try:
+            i = self.indices.index(index)
+        except ValueError:
+            self.indices.append(index)
+            self.counts.append(count)
+        else:
+            self.counts[i] += count
 
     def count(self, location):
-        return self.dict.get(id(location), 0)
+        try:
+            return self.counts[self.indices.index(location_index(location))]
+        except ValueError:
+            return 0
 
     def __contains__(self, location):
-        return id(location) in self.dict
+        return location_index(location) in self.indices
     
     def contains(self, location):
-        return id(location) in self.dict
+        return location_index(location) in self.indices
 
     def __len__(self):
-        return len(self.dict)
+        return len(self.indices)
 
     def __repr__(self):
-        return "<LocationSet %r>" % (self.dict,)
+        return "<LocationSet %r>" % (dict(zip(self.indices, self.counts)),)
 
 class Cell(object):
+    __slots__ = ("x", "y", "wojewodztwa", "powiaty", "gminy")
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -64,20 +102,61 @@ class Cell(object):
                         self.x, self.y, len(self.wojewodztwa),
                                 len(self.powiaty), len(self.gminy))
 
+def bounding_box(places, reporting = None):
+    """Return (left, right, top, bottom) of the places."""
+    left, right, top, bottom = 180, -180, -90, 90
+    for p in places:
+        if reporting:
+            reporting.progress()
+        left = min(left, p.lon)
+        right = max(right, p.lon)
+        top = max(top, p.lat)
+        bottom = min(bottom, p.lat)
+    return left, right, top, bottom
+
+def cell_indices(lons, lats, left, bottom, lon_ratio, lat_ratio):
+    """Return lists of x and y cell indices of the points given by the
+    `lons` and `lats` sequences, computed for all the points at once."""
+    if HAVE_NUMPY:
+        xs = ((numpy.asarray(lons, float) - left) / lon_ratio).astype(int)
+        ys = ((numpy.asarray(lats, float) - bottom) / lat_ratio).astype(int)
+        return xs.tolist(), ys.tolist()
+    xs = [int((lon - left) / lon_ratio) for lon in lons]
+    ys = [int((lat - bottom) / lat_ratio) for lat in lats]
+    return xs, ys
+
+def count_pairs(keys, codes):
+    """Return sorted list of (key, code, count) tuples for every distinct
+    pair of the `keys` and `codes` items."""
+    if HAVE_NUMPY and len(keys):
+        keys = numpy.asarray(keys, numpy.int64)
+        codes = numpy.asarray(codes, numpy.int64)
+        low = codes.min()
+        span = codes.max() - low + 1
+        pairs, counts = numpy.unique(keys * span + (codes - low),
+                                                    return_counts = True)
+        keys, codes = numpy.divmod(pairs, span)
+        return list(zip(keys.tolist(), (codes + low).tolist(),
+                                                        counts.tolist()))
+    counts = {}
+    for pair in zip(keys, codes):
+        counts[pair] = counts.get(pair, 0) + 1
+    return sorted([(key, code, count)
+                            for (key, code), count in counts.items()])
+
 class Grid(object):
-    def __init__(self, places, width, height):
+    def __init__(self, places, width, height, bbox = None):
         self.width = width
         self.height = height
         reporting = Reporting()
-        reporting.progress_start("Creating grid %ix%i" % (width, height),
+        if bbox is None:
+            reporting.progress_start("Creating grid %ix%i" % (width, height),
                                                             len(places) * 2)
-        left, right, top, bottom = 180, -180, -90, 90
-        for p in places:
-            reporting.progress()
-            left = min(left, p.lon)
-            right = max(right, p.lon)
-            top = max(top, p.lat)
-            bottom = min(bottom, p.lat)
+            bbox = bounding_box(places, reporting)
+        else:
+            reporting.progress_start("Creating grid %ix%i" % (width, height),
+                                                                len(places))
+        left, right, top, bottom = bbox
         reporting.output_msg("info", "Bounding box: (%r,%r,%r,%r)" % (
                                             left, bottom, right, top))
         self.left = left
@@ -92,16 +171,71 @@ class Grid(object):
         for x in range(0, width):
             for y in range(0, height):
                 self.cells[(x,y)] = Cell(x,y)
-        for place in places:
-            reporting.progress()
-            cell = self.get_cell(place)
-            cell.add_place(place)
+        self.add_places(places, reporting)
         reporting.progress_stop()
 
-    def get_cell(self, place):
+    def add_place(self, place):
+        cell = self.get_cell(place)
+        cell.add_place(place)
+
+    def add_places(self, places, reporting = None):
+        """Add places to their cells, with `_add_places_batch` when NumPy
+        is available."""
+        if HAVE_NUMPY:
+            self._add_places_batch(places, reporting)
+            return
+        for place in places:
+            if reporting:
+                reporting.progress()
+            self.add_place(place)
+
+    def _add_places_batch(self, places, reporting = None):
+        """Add places to their cells. The cells of all the places are
+        computed at once and the TERC units are counted per cell in a single
+        group-by, instead of adding the places one by one."""
+        places = list(places)
+        if not places:
+            return
+        xs, ys = self.cell_indices(places)
+        if (min(xs) < 0 or max(xs) >= self.width
+                            or min(ys) < 0 or max(ys) >= self.height):
+            raise KeyError, "place outside of the grid"
+        height = self.height
+        cell_nos = [x * height + y for x, y in izip(xs, ys)]
+        for place_attr, cell_attr in CELL_LOCATIONS:
+            codes = [location_index(getattr(p, place_attr)) for p in places]
+            for cell_no, code, count in count_pairs(cell_nos, codes):
+                cell = self.cells[divmod(cell_no, height)]
+                getattr(cell, cell_attr).add_index(code, count)
+        if reporting:
+            reporting.progress(len(places))
+
+    def cell_index(self, place):
+        """Return (x, y) index of the cell of a place."""
         x = int((place.lon - self.left) / self.lon_ratio)
         y = int((place.lat - self.bottom) / self.lat_ratio)
-        return self.cells[(x, y)]
+        return x, y
+
+    def cell_indices(self, places):
+        """Return lists of x and y indices of the cells of the places."""
+        return cell_indices([p.lon for p in places], [p.lat for p in places],
+                        self.left, self.bottom, self.lon_ratio, self.lat_ratio)
+
+    def get_cell(self, place):
+        return self.cells[self.cell_index(place)]
+
+    def get_cells(self, places):
+        """Return list of cells of the places, `None` for places outside
+        of the grid."""
+        cells = self.cells
+        return [cells.get(key) for key in izip(*self.cell_indices(places))]
+
+    def near(self, place, other):
+        """Check if two places are in the same cell."""
+        try:
+            return self.get_cell(place) is self.get_cell(other)
+        except KeyError:
+            return False
 
     def __unicode__(self):
         return u"%ix%i (%f, %f, %f, %f)" % (
@@ -109,3 +243,43 @@ class Grid(object):
                         self.left, self.bottom, self.right, self.top)
 
 
+
+class GridPyramid(object):
+    """Grids of several sizes over the same places.
+
+    New places are added with `add`. The grids are only built again when
+    a new place is outside the current bounding box, so they are always
+    the same as grids built from scratch."""
+    def __init__(self, places, sizes):
+        self.places = list(places)
+        self.place_ids = set([id(p) for p in self.places])
+        self.sizes = sizes
+        self.bbox = bounding_box(self.places)
+        self._build()
+
+    def _build(self):
+        self.grids = {}
+        for width, height in self.sizes:
+            self.grids[(width, height)] = Grid(self.places, width, height,
+                                                                    self.bbox)
+
+    def add(self, places):
+        places = [p for p in places if id(p) not in self.place_ids]
+        if not places:
+            return
+        self.places += places
+        self.place_ids.update([id(p) for p in places])
+        left, right, top, bottom = bounding_box(places)
+        old_left, old_right, old_top, old_bottom = self.bbox
+        bbox = (min(left, old_left), max(right, old_right),
+                        max(top, old_top), min(bottom, old_bottom))
+        if bbox != self.bbox:
+            self.bbox = bbox
+            self._build()
+            return
+        for grid in self.grids.values():
+            grid.add_places(places)
+
+    def get(self, width, height):
+        """Return the grid of given size."""
+        return self.grids[(width, height)]
@@ -0,0 +1,176 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Incremental matching after a new TERYT edition.
+
+The SIMC catalog, the OSM places and the match results of a run are
+stored in a state file. On the next run the catalog rows are compared by
+SYM, the OSM places by id, and only the OSM places affected by the changed,
+added or removed entries are matched again. The other places get their
+previous assignment back."""
+
+__version__ = "$Revision$"
+
+import os
+import cPickle as pickle
+from teryt2osm.snapshot import SNAPSHOT_DIR
+from teryt2osm.simc import SIMC_Place
+from teryt2osm.osm_places import OSM_Place
+from teryt2osm.reporting import Reporting
+
+STATE_FILE = os.path.join(SNAPSHOT_DIR, "combine.state")
+STATE_FORMAT = 2
+
+def catalog_rows():
+    """Return dictionary mapping SIMC ids to the place data used for
+    matching and tagging."""
+    rows = {}
+    for place in SIMC_Place.all():
+        rows[place.id] = (place.rm, place.name, place.terc_id,
+                                            place.parent_id, place.date)
+    return rows
+
+def osm_rows():
+    """Return dictionary mapping OSM ids to the place data used for
+    matching."""
+    rows = {}
+    for place in OSM_Place.all():
+        rows[place.id] = (place.name, place.type, place.lat, place.lon)
+    return rows
+
+def save_state(assigned):
+    """Store the loaded catalog and the assignments of the current run."""
+    if not os.path.exists(SNAPSHOT_DIR):
+        os.mkdir(SNAPSHOT_DIR)
+    matches = {}
+    for place in assigned:
+        matches[place.id] = place.simc_place.id
+    state = {
+            "catalog": catalog_rows(),
+            "osm_places": osm_rows(),
+            "matches": matches,
+            }
+    tmp_filename = STATE_FILE + ".tmp"
+    stream = open(tmp_filename, "wb")
+    try:
+        pickle.dump(STATE_FORMAT, stream, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(state, stream, pickle.HIGHEST_PROTOCOL)
+    finally:
+        stream.close()
+    os.rename(tmp_filename, STATE_FILE)
+
+def load_state():
+    """Load the state stored by the previous run. Return `None` if there
+    is none."""
+    if not os.path.exists(STATE_FILE):
+        return None
+    stream = open(STATE_FILE, "rb")
+    try:
+        try:
+            if pickle.load(stream) != STATE_FORMAT:
+                return None
+            return pickle.load(stream)
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            return None
+    finally:
+        stream.close()
+
+def _depends_on(simc_place, changed):
+    while simc_place:
+        if simc_place.id in changed:
+            return True
+        simc_place = simc_place.parent
+    return False
+
+def restore_state(state):
+    """Restore the previous assignments of the places not affected by
+    the catalog or OSM changes.
+
+    Return (affected, restored) tuple: set of the affected places, which
+    should be matched again, and set of the places which got their
+    previous assignment back."""
+    reporting = Reporting()
+    old_rows = state["catalog"]
+    new_rows = catalog_rows()
+    changed = set()
+    names = set()
+    for place_id, row in new_rows.items():
+        old_row = old_rows.get(place_id)
+        if old_row != row:
+            changed.add(place_id)
+            names.add(row[1].lower())
+            if old_row:
+                names.add(old_row[1].lower())
+    for place_id in set(old_rows) - set(new_rows):
+        changed.add(place_id)
+        names.add(old_rows[place_id][1].lower())
+    reporting.output_msg("info", u"Zmienionych rekordów SIMC: %i" % (
+                                                            len(changed),))
+
+    # new, changed and removed OSM places and the places sharing a name
+    # with them
+    old_places = state["osm_places"]
+    new_places = osm_rows()
+    changed_places = set()
+    for place_id, row in new_places.items():
+        old_row = old_places.get(place_id)
+        if old_row != row:
+            changed_places.add(place_id)
+            if row[0]:
+                names.add(row[0].lower())
+            if old_row and old_row[0]:
+                names.add(old_row[0].lower())
+    removed_places = set(old_places) - set(new_places)
+    for place_id in removed_places:
+        if old_places[place_id][0]:
+            names.add(old_places[place_id][0].lower())
+    reporting.output_msg("info", u"Nowych, zmienionych i usuniętych"
+                    u" miejsc OSM: %i" % (len(changed_places)
+                                                + len(removed_places),))
+
+    matches = state["matches"]
+    affected = set()
+    restored = set()
+    for place in OSM_Place.all():
+        if place.id in changed_places:
+            affected.add(place)
+            continue
+        if place.name and place.name.lower() in names:
+            affected.add(place)
+            continue
+        if place.simc_place:
+            if _depends_on(place.simc_place, changed):
+                affected.add(place)
+            continue
+        simc_id = matches.get(place.id)
+        if not simc_id:
+            continue
+        if simc_id in changed:
+            affected.add(place)
+            continue
+        simc_place = SIMC_Place.by_id(simc_id)
+        if _depends_on(simc_place, changed) or simc_place.osm_place:
+            affected.add(place)
+            continue
+        place.assign_simc(simc_place)
+        simc_place.assign_osm(place)
+        restored.add(place)
+    reporting.output_msg("info", u"Miejsc do ponownego dopasowania: %i" % (
+                                                            len(affected),))
+    return affected, restored
@@ -23,34 +23,87 @@ Basic OSM objects.
 
 __version__ = "$Revision: 11 $"
 
+import xml.etree.cElementTree as ElementTree
+from teryt2osm.utils import intern_string
+
+# tags with values from small sets, shared between all the elements loaded
+SHARED_VALUE_TAGS = frozenset(["place", "is_in", "is_in:country",
+        "is_in:province", "is_in:county", "is_in:municipality", "source"])
+
+def read_tags(element):
+    """Read tags of an OSM element into a dictionary."""
+    tags = {}
+    for sub in element:
+        if sub.tag == 'tag':
+            tags[sub.attrib["k"]] = sub.attrib["v"]
+    return tags
+
+def intern_tags(tags):
+    """Return copy of a tags dictionary with the keys and the values
+    of `SHARED_VALUE_TAGS` shared between all the elements loaded."""
+    result = {}
+    for key, value in tags.items():
+        key = intern_string(key)
+        if key in SHARED_VALUE_TAGS:
+            value = intern_string(value)
+        result[key] = value
+    return result
+
+def parse_node(element):
+    """Extract node data from an XML element.
+
+    Return (id, version, changeset, lat, lon, tags, attributes) tuple,
+    which may be passed to `OSM_Node.from_row`. `attributes` are all
+    the original (name, value) pairs of the element attributes.
+
+    The strings are not shared yet, as the rows may be parsed in other
+    processes. This is done by `OSM_Node.from_row`."""
+    attributes = tuple(element.attrib.items())
+    return (element.attrib["id"], element.attrib.get("version"),
+            element.attrib.get("changeset"), float(element.attrib["lat"]),
+            float(element.attrib["lon"]), read_tags(element), attributes)
+
 class OSM_Node(object):
+    __slots__ = ("id", "version", "changeset", "lon", "lat", "tags", "name",
+                                                                "attributes")
     def __init__(self, element):
-        self.id = element.attrib["id"]
-        self.version = element.attrib.get("version")
-        self.changeset = element.attrib.get("changeset")
-        self.lon = float(element.attrib["lon"])
-        self.lat = float(element.attrib["lat"])
-        self.tags = {}
-        for sub in element:
-            if sub.tag == 'tag':
-                key = sub.attrib["k"]
-                value = sub.attrib["v"]
-                self.tags[key] = value
+        self._set_row(parse_node(element))
+
+    @classmethod
+    def from_row(cls, row):
+        """Create a node from a tuple returned by `parse_node`."""
+        node = cls.__new__(cls)
+        node._set_row(row)
+        return node
+
+    def _set_row(self, row):
+        self.id, version, changeset, self.lat, self.lon, tags, attributes = row
+        self.version = intern_string(version)
+        self.changeset = intern_string(changeset)
+        self.tags = intern_tags(tags)
+        self.attributes = tuple([(intern_string(name), value)
+                                            for name, value in attributes])
         self.name = self.tags.get("name")
+
+    def to_element(self):
+        """Build an XML element representing the node, with the original
+        attributes."""
+        element = ElementTree.Element(u"node", dict(self.attributes))
+        for key, value in self.tags.items():
+            ElementTree.SubElement(element, u"tag", k = key, v = value)
+        return element
        
 class OSM_Way(object):
+    __slots__ = ("id", "version", "changeset", "tags", "node_ids", "nodes",
+                                                        "complete", "name")
     def __init__(self, element):
         self.id = element.attrib["id"]
-        self.version = element.attrib.get("version")
-        self.changeset = element.attrib.get("changeset")
-        self.tags = {}
+        self.version = intern_string(element.attrib.get("version"))
+        self.changeset = intern_string(element.attrib.get("changeset"))
+        self.tags = intern_tags(read_tags(element))
         self.node_ids = []
         self.complete = False
         for sub in element:
-            if sub.tag == 'tag':
-                key = sub.attrib["k"]
-                value = sub.attrib["v"]
-                self.tags[key] = value
             if sub.tag == 'nd':
                 node_id = sub.attrib["ref"]
                 self.node_ids.append(node_id)
@@ -19,46 +19,135 @@
 
 """
 Handle OSM boundary relations.
+
+The assembled rings of a boundary, with its tags, are cached in a binary
+file next to the OSM file, so it is parsed only when it has changed.
 """
 
 __version__ = "$Revision: 11 $"
 
+import os
 import sys
+import struct
+from itertools import izip
 import xml.etree.cElementTree as ElementTree
-from teryt2osm.utils import add_to_list_dict, count_elements
+from teryt2osm.utils import add_to_list_dict, ProgressFile
 from teryt2osm.terc import Wojewodztwo, Powiat, Gmina, load_terc
 from teryt2osm.simc import SIMC_Place, place_aliases
 from teryt2osm.reporting import Reporting
 from teryt2osm.osm import OSM_Node, OSM_Way
-        
+from teryt2osm.snapshot import file_signature
+from teryt2osm.polygons import Polygons, Area, INSIDE, EDGE, load_raster_mask
+from teryt2osm.polygons import SOURCE_SIGNATURE, source_matches
+
 try:
     from shapely.geometry import Point, MultiPolygon
     HAVE_SHAPELY=True
 except ImportError:
     HAVE_SHAPELY=False
 
+# the number in the magic is increased on every change of the way
+# the rings are assembled, so the boundaries stored before are read again
+BOUNDARY_MAGIC = "T2OBND02"
+# open flag, outer and inner ways count, attributes and tags data size
+BOUNDARY_HEADER = struct.Struct("<?III")
+
+def assemble_rings(ways):
+    """Chain complete `OSM_Way` objects into rings of (lat, lon) pairs.
+
+    Each ring starts with the first way not used yet and is continued
+    with the first way (in the `ways` order) starting or ending where
+    the ring ends. The ways are found by their end nodes in a dictionary.
+
+    Return (rings, open) tuple, `open` is True when any ring could not
+    be closed."""
+    by_end = {}
+    for pos, way in enumerate(ways):
+        add_to_list_dict(by_end, way.start_node, pos)
+        if way.end_node is not way.start_node:
+            add_to_list_dict(by_end, way.end_node, pos)
+    used = [False] * len(ways)
+    ways_left = len(ways)
+    first = 0
+    rings = []
+    is_open = False
+    while ways_left:
+        while used[first]:
+            first += 1
+        segment_start = ways[first]
+        used[first] = True
+        ways_left -= 1
+        ring = [(node.lat, node.lon) for node in segment_start.nodes]
+        last_end = segment_start.end_node
+        while ways_left:
+            if last_end is segment_start.start_node:
+                # cycle ended
+                break
+            candidates = [pos for pos in by_end.get(last_end, [])
+                                                        if not used[pos]]
+            if not candidates:
+                # open segment ends
+                is_open = True
+                break
+            by_end[last_end] = candidates
+            pos = candidates[0]
+            way = ways[pos]
+            used[pos] = True
+            ways_left -= 1
+            if way.start_node is last_end:
+                last_end = way.end_node
+                nodes = way.nodes[1:]
+            else:
+                last_end = way.start_node
+                nodes = way.nodes[-2::-1]
+            ring += [(node.lat, node.lon) for node in nodes]
+        rings.append(ring)
+    return rings, is_open
+
+def _decode_string(data):
+    """Decode UTF-8 string, leaving ASCII strings as `str`, like
+    ElementTree does."""
+    try:
+        data.decode("ascii")
+        return data
+    except UnicodeDecodeError:
+        return data.decode("utf-8")
+
+def load_ways(way_elements, node_elements):
+    """Build `OSM_Way` objects, with their nodes, from XML elements.
+    Return dictionary of the ways by id."""
+    nodes = {}
+    for element in node_elements:
+        node = OSM_Node(element)
+        nodes[node.id] = node
+
+    ways = {}
+    for element in way_elements:
+        way = OSM_Way(element)
+        way.add_nodes(nodes)
+        ways[way.id] = way
+    return ways
+
 class OSM_Boundary(object):
-    def __init__(self, relation_element, way_elements, node_elements):
+    _impl_reported = False
+    def __init__(self, relation_element, way_elements, node_elements,
+                                                                ways = None):
+        """Build the boundary of a relation. The member ways are given
+        by their elements and the elements of their nodes or, already
+        complete, in the `ways` dictionary (by way id)."""
         self.polygons = []
+        self.inner_polygons = []
         self.ways = {}
+        self.inner_ways = {}
         self.relation = relation_element
         self.open = True
-        reporting = Reporting()
         self.id = relation_element.attrib["id"]
         self.version = relation_element.attrib["version"]
         self.changeset = relation_element.attrib["changeset"]
         self.tags = {}
 
-        nodes = {}
-        for element in node_elements:
-            node = OSM_Node(element)
-            nodes[node.id] = node
-
-        ways = {}
-        for element in way_elements:
-            way = OSM_Way(element)
-            way.add_nodes(nodes)
-            ways[way.id] = way
+        if ways is None:
+            ways = load_ways(way_elements, node_elements)
 
         for sub in relation_element:
             if sub.tag == 'tag':
@@ -67,65 +156,55 @@ class OSM_Boundary(object):
                 self.tags[key] = value
             elif sub.tag == 'member' and sub.attrib["type"] == 'way':
                 role = sub.attrib.get("role", "")
-                if role:
+                if role not in ("", "outer", "inner"):
                     raise NotImplementedError, "Role %r for relation way members not supported" % (role,)
                 way_id = sub.attrib["ref"]
                 way = ways.get(way_id)
                 if way:
                     if not way.complete:
                         raise ValueError, "Incomplete way: %r" % (way,)
-                    self.ways[way_id] = way
+                    if role == "inner":
+                        self.inner_ways[way_id] = way
+                    else:
+                        self.ways[way_id] = way
                 else:
                     raise ValueError, "Way not found: %r" % (way_id,)
 
         self.name = self.tags.get("name")
         if not self.ways:
             raise ValueError, "No ways"
+        self.ways_count = len(self.ways)
+        self.inner_ways_count = len(self.inner_ways)
         
-        self.open = False
-        ways_left = self.ways.values()
-        while ways_left:
-            segment_start = ways_left.pop(0)
-            polygon = []
-            for node in segment_start.nodes:
-                polygon.append((node.lat, node.lon))
-            last_end = segment_start.end_node
-            while ways_left:
-                if last_end is segment_start.start_node:
-                    # cycle ended
-                    break
-                next = None
-                for way in ways_left:
-                    if way.start_node is last_end:
-                        last_end = way.end_node
-                        for node in way.nodes[1:]:
-                            polygon.append((node.lat, node.lon))
-                        next = way
-                        break
-                    elif way.end_node is last_end:
-                        last_end = way.start_node
-                        rnodes = list(way.nodes[1:])
-                        rnodes.reverse()
-                        for node in rnodes:
-                            polygon.append((node.lat, node.lon))
-                        next = way
-                        break
-                if next:
-                    ways_left.remove(next)
-                else:
-                    # open segment ends
-                    self.open = True
-                    break
-            self.polygons.append(polygon)
+        self.polygons, self.open = assemble_rings(self.ways.values())
+        self.geometry = Polygons.from_rings(self.polygons)
+        if self.inner_ways:
+            self.inner_polygons, inner_open = assemble_rings(
+                                                self.inner_ways.values())
+            self.open = self.open or inner_open
+            self.geometry = Area(self.geometry,
+                                    Polygons.from_rings(self.inner_polygons))
+        self._init_contains()
+
+    def _init_contains(self):
+        """Select the 'point in polygon' checks implementation."""
+        reporting = Reporting()
+        self.mask = None
         if HAVE_SHAPELY:
-            reporting.output_msg("info", 
+            if not OSM_Boundary._impl_reported:
+                reporting.output_msg("info", 
                     "Using Shapely for 'point in polygon' checks")
             self.multi_polygon = MultiPolygon([(p, ()) for p in self.polygons])
+            if self.inner_polygons:
+                self.multi_polygon = self.multi_polygon.difference(
+                        MultiPolygon([(p, ()) for p in self.inner_polygons]))
             self. _contains_impl = self._contains_shapely_impl
         else:
-            reporting.output_msg("info", 
-                "Using Python function for the 'point in polygon' checks")
+            if not OSM_Boundary._impl_reported:
+                reporting.output_msg("info", 
+                    "Using Python function for the 'point in polygon' checks")
             self. _contains_impl = self._contains_python_impl
+        OSM_Boundary._impl_reported = True
 
     def __repr__(self):
         if self.open:
@@ -133,25 +212,83 @@ class OSM_Boundary(object):
         else:
             open_s = "closed"
         return "<OSM_Boundary #%s %r %s %i ways %i polygons>" % (self.id, 
-                self.name, open_s, len(self.ways), len(self.polygons))
+                self.name, open_s, self.ways_count, len(self.polygons))
+
+    def write(self, filename, source):
+        """Write the attributes, tags and rings of the boundary to a file,
+        with the signature of the `source` OSM file."""
+        strings = [self.id, self.version, self.changeset]
+        for key, value in self.tags.items():
+            strings += [key, value]
+        strings = "\0".join([unicode(s).encode("utf-8") for s in strings])
+        if isinstance(self.geometry, Area):
+            outer, inner = self.geometry.outer, self.geometry.inner
+        else:
+            outer, inner = self.geometry, Polygons.from_rings([])
+        tmp_filename = filename + ".tmp"
+        stream = open(tmp_filename, "wb")
+        try:
+            stream.write(BOUNDARY_MAGIC)
+            stream.write(SOURCE_SIGNATURE.pack(*file_signature(source)))
+            stream.write(BOUNDARY_HEADER.pack(self.open, self.ways_count,
+                                    self.inner_ways_count, len(strings)))
+            stream.write(strings)
+            stream.write(outer.tostring())
+            stream.write(inner.tostring())
+        finally:
+            stream.close()
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def read(cls, filename, source):
+        """Read boundary written by `write`. Return `None` if the file
+        does not exist or does not match the `source` file."""
+        if not os.path.exists(filename):
+            return None
+        stream = open(filename, "rb")
+        try:
+            data = stream.read()
+        finally:
+            stream.close()
+        offset = len(BOUNDARY_MAGIC) + SOURCE_SIGNATURE.size
+        if (len(data) < offset + BOUNDARY_HEADER.size
+                                    or not data.startswith(BOUNDARY_MAGIC)):
+            return None
+        if not source_matches(data, len(BOUNDARY_MAGIC), source):
+            return None
+        is_open, ways_count, inner_ways_count, strings_size = \
+                                    BOUNDARY_HEADER.unpack_from(data, offset)
+        offset += BOUNDARY_HEADER.size
+        strings = data[offset:offset + strings_size].split("\0")
+        offset += strings_size
+        try:
+            outer, offset = Polygons.fromstring(data, offset)
+            inner, offset = Polygons.fromstring(data, offset)
+        except ValueError:
+            return None
+        strings = [_decode_string(s) for s in strings]
+        boundary = cls.__new__(cls)
+        (boundary.id, boundary.version,
+                                boundary.changeset) = strings[:3]
+        boundary.tags = dict(zip(strings[3::2], strings[4::2]))
+        boundary.name = boundary.tags.get("name")
+        boundary.relation = None
+        boundary.ways = {}
+        boundary.inner_ways = {}
+        boundary.ways_count = ways_count
+        boundary.inner_ways_count = inner_ways_count
+        boundary.open = is_open
+        boundary.polygons = outer.rings()
+        boundary.inner_polygons = inner.rings()
+        if len(inner):
+            boundary.geometry = Area(outer, inner)
+        else:
+            boundary.geometry = outer
+        boundary._init_contains()
+        return boundary
 
     def _contains_python_impl(self, location):
-        lat = location.lat
-        lon = location.lon
-        for pol in self.polygons:
-            contains = False
-            plen = len(pol)
-            i = 0
-            j = plen - 1
-            while i < plen:
-                if ( ((pol[i][0] > lat) != (pol[j][0] > lat)) and 
-                        (lon < ((pol[j][1] - pol[i][1]) * (lat - pol[i][0]) / (pol[j][0] - pol[i][0]) + pol[i][1])) ):
-                    contains = not contains
-                j = i
-                i += 1
-            if contains:
-                return True
-        return False
+        return self.geometry.contains(location.lat, location.lon)
     
     def _contains_shapely_impl(self, location):
         point = Point(location.lat, location.lon)
@@ -160,37 +297,85 @@ class OSM_Boundary(object):
     def __contains__(self, location):
         if self.open:
             return True
+        if self.mask is not None:
+            label = self.mask.lookup(location.lat, location.lon)
+            if label != EDGE:
+                return label == INSIDE
         return self._contains_impl(location)
+
+    def contains_many(self, lats, lons):
+        """Check many points at once. Return list of flags telling which
+        of the points given by the `lats` and `lons` sequences are inside
+        the boundary."""
+        if self.open:
+            return [True] * len(lats)
+        if self.mask is None:
+            return self.geometry.contains_many(lats, lons)
+        labels = self.mask.lookup_many(lats, lons)
+        result = [label == INSIDE for label in labels]
+        edge = [i for i, label in enumerate(labels) if label == EDGE]
+        if edge:
+            exact = self.geometry.contains_many([lats[i] for i in edge],
+                                                    [lons[i] for i in edge])
+            for i, flag in izip(edge, exact):
+                result[i] = flag
+        return result
+
+    def use_mask(self, source):
+        """Use a `teryt2osm.polygons.RasterMask`, stored next to the
+        `source` file, for quick checks of points far from the boundary
+        lines."""
+        if not self.open:
+            self.mask = load_raster_mask(source, self.geometry)
+
+def boundary_filename(source):
+    return source + ".boundary"
     
-def load_osm_boundary(filename):
+def load_osm_boundary(filename, use_mask = True):
     """Loads a boundary relation from an OSM file. The file must also
     contain all the nodes and way used by the boundary. Only the first boundary
-    is read."""
+    is read. The boundary is read from the cache next to the file, if it is
+    up to date, or stored there, when possible. With `use_mask` the raster
+    mask of the boundary is loaded or computed and stored next to
+    the file."""
     reporting = Reporting()
-    elem_count = count_elements(filename, "node")
-    elem_count += count_elements(filename, "way")
-    elem_count += 1
-    reporting.progress_start(u"Ładuję %s" % (filename,), elem_count)
+    cache_filename = boundary_filename(filename)
+    boundary = OSM_Boundary.read(cache_filename, filename)
+    if boundary is not None:
+        reporting.output_msg("stats", u"Załadowano granicę z %s."
+                                                    % (cache_filename,))
+        if use_mask:
+            boundary.use_mask(filename)
+        return boundary
     nodes = []
     ways = []
     relation = None
-    for event, elem in ElementTree.iterparse(filename):
-        if event != 'end':
-            continue
-        if elem.tag == 'node':
-            nodes.append(elem)
-        elif elem.tag == 'way':
-            ways.append(elem)
-        elif elem.tag == 'relation' and not relation:
-            relation = elem
-        else:
-            continue
-        reporting.progress()
-    reporting.progress_stop()
+    stream = ProgressFile(filename)
+    try:
+        reporting.progress_start(u"Ładuję %s" % (filename,), stream.size)
+        for event, elem in ElementTree.iterparse(stream):
+            if event != 'end':
+                continue
+            if elem.tag == 'node':
+                nodes.append(elem)
+            elif elem.tag == 'way':
+                ways.append(elem)
+            elif elem.tag == 'relation' and not relation:
+                relation = elem
+        reporting.progress_stop()
+    finally:
+        stream.close()
     if not relation:
         reproting.output_msg("errors", u"Nie znaleziono relacji")
         raise ValueError, "Relation not found"
     reporting.output_msg("stats", u"Załadowano relację, %i dróg i %i węzłów." 
                     % (len(ways), len(nodes)))
     boundary = OSM_Boundary(relation, ways, nodes)
+    try:
+        boundary.write(cache_filename, filename)
+    except (IOError, OSError), err:
+        reporting.output_msg("errors", u"Nie można zapisać granicy %s: %s"
+                    % (cache_filename, str(err).decode("utf-8", "replace")))
+    if use_mask:
+        boundary.use_mask(filename)
     return boundary
@@ -25,13 +25,16 @@ __version__ = "$Revision$"
 
 import sys
 import xml.etree.cElementTree as ElementTree
-from teryt2osm.utils import add_to_list_dict, count_elements
+from teryt2osm.utils import add_to_list_dict, ProgressFile, iter_elements
+from teryt2osm.utils import intern_string
 from teryt2osm.terc import Wojewodztwo, Powiat, Gmina, load_terc, parse_terc
 from teryt2osm.simc import SIMC_Place, place_aliases, parse_simc
 from teryt2osm.reporting import Reporting
-from teryt2osm.osm import OSM_Node
+from teryt2osm.osm import OSM_Node, parse_node
 
 class OSM_Place(OSM_Node):
+    __slots__ = ("wojewodztwo", "powiat", "gmina", "simc_id", "terc_id",
+                    "simc_place", "type", "normalized_type", "is_in")
     _by_id = {}
     _by_simc_id = {}
     _by_name = {}
@@ -39,11 +42,10 @@ class OSM_Place(OSM_Node):
     woj_matched = 0
     pow_matched = 0
     gmi_matched = 0
-    def __init__(self, element):
-        OSM_Node.__init__(self, element)
+    def _set_row(self, row):
+        OSM_Node._set_row(self, row)
         reporting = Reporting()
 
-        self.element = element
         self.wojewodztwo = None
         self.powiat = None
         self.gmina = None
@@ -61,7 +63,7 @@ class OSM_Place(OSM_Node):
 
         if "is_in" in tags:
             is_in_parts = [s.strip() for s in tags["is_in"].split(",")]
-            self.is_in = ", ".join(is_in_parts)
+            self.is_in = intern_string(", ".join(is_in_parts))
         else:
             is_in_parts = []
             self.is_in = None
@@ -114,7 +116,7 @@ class OSM_Place(OSM_Node):
                 gmi = Gmina.try_by_name(part, False, 
                                 powiat = self.powiat, place_name = self.name)
                 if gmi:
-                    self.gmi = gmi 
+                    self.gmina = gmi
                     OSM_Place.gmi_matched += 1
                     break
 
@@ -322,12 +324,12 @@ class OSM_Place(OSM_Node):
     @classmethod
     def by_id(cls, place_id):
         """Return single place identified by a OSM id."""
-        return self._by_id[place_id]
+        return cls._by_id[place_id]
 
     @classmethod
     def by_simc_id(cls, simc_id):
         """Return single place identified by a SIMC id."""
-        return self._by_simc_id[simc_id]
+        return cls._by_simc_id[simc_id]
 
     @classmethod
     def by_name(cls, name):
@@ -358,15 +360,30 @@ class OSM_Place(OSM_Node):
         else:
             return self.name
 
-def load_osm():
+def read_osm_rows(filename):
+    """Parse all nodes of an OSM file into tuples returned by
+    `teryt2osm.osm.parse_node`."""
+    return [parse_node(elem) for elem in iter_elements(filename, "node")]
+
+def load_osm(rows = None):
+    """Load places from data/data.osm. If `rows` is given, it should
+    be a result of `read_osm_rows` and the file is not parsed again."""
     reporting = Reporting()
-    row_count = count_elements("data/data.osm", "node")
-    reporting.progress_start(u"Ładuję data/data.osm", row_count)
-    for event, elem in ElementTree.iterparse("data/data.osm"):
-        if event == 'end' and elem.tag == 'node':
-            osm_place = OSM_Place(elem)
+    if rows is not None:
+        reporting.progress_start(u"Ładuję data/data.osm", len(rows))
+        for row in rows:
+            osm_place = OSM_Place.from_row(row)
             reporting.progress()
-    reporting.progress_stop()
+        reporting.progress_stop()
+    else:
+        stream = ProgressFile("data/data.osm")
+        try:
+            reporting.progress_start(u"Ładuję data/data.osm", stream.size)
+            for elem in iter_elements(stream, "node"):
+                osm_place = OSM_Place(elem)
+            reporting.progress_stop()
+        finally:
+            stream.close()
     reporting.output_msg("stats", u"Załadowano %i miejsc." 
                     u"Dopasowano %i województw, %i powiatów i %i gmin." % (
                     OSM_Place.count(), OSM_Place.woj_matched,
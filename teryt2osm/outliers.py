@@ -0,0 +1,120 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""
+Batch detection of badly matched places.
+
+A matched place is suspicious when few places in the same area share its
+powiat (or województwo, for places named after their powiat). Grid cells
+and squares are given by keys computed for all the places at once and the
+places are counted by (area, unit) key with a single group-by. The
+neighbourhoods of `teryt2osm.spatial.RadiusGrid` overlap, so there each
+place is checked against its own neighbourhood.
+"""
+
+__version__ = "$Revision$"
+
+import math
+from itertools import izip
+from teryt2osm.grid import location_index
+from teryt2osm.spatial import KM_PER_DEGREE_LAT, KM_PER_DEGREE_LON
+
+class KeyAreas(object):
+    """Areas given by a key of each place."""
+    def counts(self, places, reference):
+        """Return, for each of the places, the number of the `reference`
+        places in the same area sharing its unit."""
+        ref_keys = self.keys(reference)
+        ref_keys = ref_keys + ref_keys
+        ref_codes = powiat_codes(reference) + wojewodztwo_codes(reference)
+        return count_same(self.keys(places), unit_codes(places),
+                                                    ref_keys, ref_codes)
+
+class CellAreas(KeyAreas):
+    """Cells of a `teryt2osm.grid.Grid` as the areas."""
+    def __init__(self, grid):
+        self.grid = grid
+
+    def keys(self, places):
+        height = self.grid.height
+        xs, ys = self.grid.cell_indices(places)
+        return [x * height + y for x, y in izip(xs, ys)]
+
+class SquareAreas(KeyAreas):
+    """Squares with the area of a circle of `radius` km as the areas.
+    The side of a square is `radius` * sqrt(pi)."""
+    def __init__(self, radius, reference):
+        self.radius = radius
+        self.side = radius * math.sqrt(math.pi)
+        if reference:
+            lat0 = sum([p.lat for p in reference]) / len(reference)
+        else:
+            lat0 = 0.0
+        self.lon_scale = KM_PER_DEGREE_LON * math.cos(math.radians(lat0))
+        self.lat_scale = KM_PER_DEGREE_LAT
+
+    def keys(self, places):
+        lon_step = self.side / self.lon_scale
+        lat_step = self.side / self.lat_scale
+        return [(int(math.floor(p.lon / lon_step)) << 20)
+                        + int(math.floor(p.lat / lat_step)) for p in places]
+
+class NeighbourhoodAreas(object):
+    """Neighbourhoods of a `teryt2osm.spatial.RadiusGrid` as the areas.
+    The grid index holds the reference places."""
+    def __init__(self, grid):
+        self.grid = grid
+
+    def counts(self, places, reference):
+        result = []
+        for place, cell in izip(places, self.grid.get_cells(places)):
+            if place.simc_place.name == place.powiat.name:
+                result.append(cell.wojewodztwa.count(place.wojewodztwo))
+            else:
+                result.append(cell.powiaty.count(place.powiat))
+        return result
+
+def powiat_codes(places):
+    return [(location_index(p.powiat) + 1) * 2 for p in places]
+
+def wojewodztwo_codes(places):
+    return [(location_index(p.wojewodztwo) + 1) * 2 + 1 for p in places]
+
+def unit_codes(places):
+    """Return codes of the TERC units the places are checked against:
+    the powiat or, for places named like their powiat, the województwo."""
+    return [c_woj if p.simc_place.name == p.powiat.name else c_pow
+                for p, c_pow, c_woj in izip(places, powiat_codes(places),
+                                                wojewodztwo_codes(places))]
+
+def count_same(keys, codes, ref_keys, ref_codes):
+    """For each (key, code) pair return the number of the equal
+    (ref_key, ref_code) pairs."""
+    counts = {}
+    for pair in izip(ref_keys, ref_codes):
+        counts[pair] = counts.get(pair, 0) + 1
+    return [counts.get(pair, 0) for pair in izip(keys, codes)]
+
+def find_outliers(places, reference, areas, min_count = 2):
+    """Return the places for which less than `min_count` `reference`
+    places in the same area share the unit."""
+    places = list(places)
+    counts = areas.counts(places, list(reference))
+    return [place for place, count in izip(places, counts)
+                                                    if count < min_count]
@@ -0,0 +1,111 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Parallel name matching.
+
+The places are split into partitions by województwo, known from the OSM
+tags or from the grid, and the partitions are matched in worker processes.
+The workers are forked when a pass starts, so they see the data as it
+was then and only return the results, which are applied by the caller.
+
+A result may depend on the places matched before in the same pass, but
+only on those with the same name (they share the SIMC candidates and are
+checked for the reverse ambiguity). The caller merging the results in the
+serial order must match such places again."""
+
+__version__ = "$Revision$"
+
+import multiprocessing
+from teryt2osm.utils import add_to_list_dict
+from teryt2osm.grid import location_index
+from teryt2osm.terc import TERCObject
+from teryt2osm.simc import SIMC_Place
+from teryt2osm.osm_places import OSM_Place
+from teryt2osm.reporting import Reporting
+
+# (match function, pass number, grid, reverse index) of the current pass,
+# inherited by the worker processes
+_job = None
+
+def _init_worker():
+    backends = set([TERCObject._database, SIMC_Place._store])
+    for backend in backends:
+        if hasattr(backend, "reopen"):
+            backend.reopen()
+
+def _match_partition(osm_ids):
+    match_place, pass_no, grid, reverse_index = _job
+    results = []
+    for osm_id in osm_ids:
+        result, simc_place, messages = match_place(pass_no,
+                            OSM_Place.by_id(osm_id), grid, reverse_index)
+        if simc_place is not None:
+            simc_place = simc_place.id
+        results.append((osm_id, result, simc_place, messages))
+    return results
+
+def partition(places, grid = None, parts = 1):
+    """Split places by województwo. The województwo is taken from the place
+    itself or from its grid cell, if the cell is in a single województwo.
+    Partitions larger than 1/`parts` of all places are split further."""
+    by_woj = {}
+    if grid:
+        cells = grid.get_cells(places)
+    else:
+        cells = [None] * len(places)
+    for place, cell in zip(places, cells):
+        woj_index = location_index(place.wojewodztwo)
+        if place.wojewodztwo is None:
+            if cell and len(cell.wojewodztwa) == 1:
+                woj_index = cell.wojewodztwa.indices[0]
+        add_to_list_dict(by_woj, woj_index, place)
+    max_size = max(1, (len(places) + parts - 1) // parts)
+    result = []
+    for woj_places in by_woj.values():
+        for i in range(0, len(woj_places), max_size):
+            result.append(woj_places[i:i + max_size])
+    return result
+
+def match_parallel(match_place, pass_no, places, grid, processes,
+                                                    reverse_index = None):
+    """Call `match_place(pass_no, place, grid, reverse_index)` for each
+    of the `places` in `processes` worker processes and report progress.
+
+    Return dictionary mapping OSM ids to the `match_place` results."""
+    global _job
+    reporting = Reporting()
+    partitions = partition(places, grid, processes * 4)
+    _job = (match_place, pass_no, grid, reverse_index)
+    pool = multiprocessing.Pool(processes, _init_worker)
+    results = {}
+    try:
+        for part_results in pool.imap_unordered(_match_partition,
+                            [[place.id for place in part] for part in partitions]):
+            for osm_id, result, simc_id, messages in part_results:
+                if simc_id is not None:
+                    simc_place = SIMC_Place.by_id(simc_id)
+                else:
+                    simc_place = None
+                results[osm_id] = (result, simc_place, messages)
+            reporting.progress(len(part_results))
+    finally:
+        pool.terminate()
+        pool.join()
+        _job = None
+    return results
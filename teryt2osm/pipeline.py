@@ -0,0 +1,83 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Concurrent loading of the input data.
+
+The XML files are parsed in worker processes into plain row tuples.
+Objects are created and linked in the main process, in the order
+required by their dependencies: TERC, SIMC, OSM."""
+
+__version__ = "$Revision$"
+
+import multiprocessing
+from teryt2osm.utils import split_xml
+from teryt2osm.terc import load_terc, read_terc_rows
+from teryt2osm.simc import load_simc, parse_simc_range
+from teryt2osm.osm_places import load_osm, read_osm_rows
+from teryt2osm.snapshot import load_snapshot
+from teryt2osm.reporting import Reporting
+
+def load_all(processes, use_snapshot = True, columnar = False):
+    """Load data/TERC.xml, data/SIMC.xml and data/data.osm, parsing
+    them concurrently in `processes` worker processes.
+
+    Catalogs with an up to date snapshot are not parsed at all."""
+    reporting = Reporting()
+    reporting.output_msg("info", u"Wczytywanie danych w %i procesach"
+                                                            % (processes,))
+    pool = multiprocessing.Pool(processes)
+    try:
+        # the largest single file goes first
+        osm_job = pool.apply_async(read_osm_rows, ("data/data.osm",))
+        terc_rows = simc_rows = None
+        if use_snapshot:
+            terc_rows = load_snapshot("data/TERC.xml")
+        if terc_rows is not None:
+            terc_job = None
+        else:
+            terc_job = pool.apply_async(read_terc_rows, ("data/TERC.xml",))
+        if use_snapshot:
+            simc_rows = load_snapshot("data/SIMC.xml")
+        if simc_rows is not None:
+            simc_jobs = None
+        else:
+            ranges = split_xml("data/SIMC.xml", "row", processes * 4)
+            simc_jobs = [pool.apply_async(parse_simc_range,
+                                    (("data/SIMC.xml", start, end),))
+                                                for start, end in ranges]
+        pool.close()
+
+        if terc_job:
+            load_terc(use_snapshot, rows = terc_job.get())
+        else:
+            load_terc(use_snapshot, rows = terc_rows, from_snapshot = True)
+
+        if simc_jobs is not None:
+            rows = []
+            for job in simc_jobs:
+                rows += job.get()
+            load_simc(use_snapshot, columnar, rows = rows)
+        else:
+            load_simc(use_snapshot, columnar, rows = simc_rows,
+                                                    from_snapshot = True)
+
+        load_osm(rows = osm_job.get())
+    finally:
+        pool.terminate()
+        pool.join()
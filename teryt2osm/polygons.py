@@ -0,0 +1,498 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""
+Point in polygon checks.
+
+The rings are kept as flat arrays of coordinates. The edges of each ring
+are put into horizontal bands, so the ray casting test of a point only
+goes through the edges of its band. Many points are checked at once by
+sorting them by latitude and sweeping the edges of each ring once over
+all of them. A point is inside when it is inside
+any of the rings. `Area` also cuts out the inner rings.
+
+`RasterMask` labels cells of a raster over the rings as inside, outside
+or crossed by an edge, so only the points in the edge cells need the ray
+casting test. The mask may be stored in a file next to the source of
+the rings.
+
+The rings may be also stored in a compact binary form, so they can be
+loaded without parsing and assembling the OSM data again.
+"""
+
+__version__ = "$Revision$"
+
+import os
+import math
+import struct
+from itertools import izip
+from array import array
+from heapq import heappush, heappop
+from teryt2osm.snapshot import file_md5, file_signature
+from teryt2osm.reporting import Reporting
+
+# average number of ring edges per band
+EDGES_PER_BAND = 4
+
+# raster mask cell labels
+OUTSIDE, INSIDE, EDGE = 0, 1, 2
+
+# raster mask rows and columns
+MASK_SIZE = 1024
+
+# signature (size, mtime, md5) of the source file of a stored object
+SOURCE_SIGNATURE = struct.Struct("<qd32s")
+
+# the number in the magic is increased on every change of the way
+# the mask is computed, so the masks stored before are built again
+MASK_MAGIC = "T2OMSK02"
+MASK_HEADER = struct.Struct("<II4d")
+
+# rings and points count of stored `Polygons`
+POLYGONS_HEADER = struct.Struct("<II")
+
+def source_matches(data, offset, source):
+    """Check if the signature at `offset` of `data` describes the
+    current contents of the `source` file."""
+    if len(data) < offset + SOURCE_SIGNATURE.size:
+        return False
+    size, mtime, md5 = SOURCE_SIGNATURE.unpack_from(data, offset)
+    stat = os.stat(source)
+    if stat.st_size != size:
+        return False
+    if stat.st_mtime != mtime and file_md5(source) != md5.rstrip("\0"):
+        return False
+    return True
+
+def _unpack_array(typecode, data, offset, count):
+    result = array(typecode)
+    end = offset + result.itemsize * count
+    if end > len(data):
+        raise ValueError, "Truncated data"
+    result.fromstring(data[offset:end])
+    return result, end
+
+class Polygons(object):
+    """Rings of (lat, lon) points. Ring `i` is made of the points from
+    `offsets[i]` to `offsets[i + 1]` of the `lats` and `lons` arrays.
+    The bounding boxes of the rings are computed unless given. The bands
+    and the sorted edges of a ring are made when it is checked for the
+    first time."""
+    def __init__(self, lats, lons, offsets, bboxes = None):
+        self.lats = lats
+        self.lons = lons
+        self.offsets = offsets
+        self.bands = [None] * (len(offsets) - 1)
+        self.sorted_edges = [None] * (len(offsets) - 1)
+        if bboxes is None:
+            bboxes = []
+            for i in range(len(offsets) - 1):
+                start, end = offsets[i], offsets[i + 1]
+                ring_lats = lats[start:end]
+                ring_lons = lons[start:end]
+                bboxes.append((min(ring_lats), min(ring_lons),
+                                            max(ring_lats), max(ring_lons)))
+        self.bboxes = bboxes
+        if self.bboxes:
+            self.bbox = (min([b[0] for b in self.bboxes]),
+                            min([b[1] for b in self.bboxes]),
+                            max([b[2] for b in self.bboxes]),
+                            max([b[3] for b in self.bboxes]))
+        else:
+            self.bbox = None
+
+    @classmethod
+    def from_rings(cls, rings):
+        """Build from lists of (lat, lon) pairs."""
+        lats = array("d")
+        lons = array("d")
+        offsets = array("i", [0])
+        for ring in rings:
+            for lat, lon in ring:
+                lats.append(lat)
+                lons.append(lon)
+            offsets.append(len(lats))
+        return cls(lats, lons, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def rings(self):
+        """Return the rings as lists of (lat, lon) pairs."""
+        lats, lons, offsets = self.lats, self.lons, self.offsets
+        return [zip(lats[offsets[i]:offsets[i + 1]],
+                                        lons[offsets[i]:offsets[i + 1]])
+                                            for i in range(len(offsets) - 1)]
+
+    def tostring(self):
+        """Return the rings packed into a string, to be read back
+        by `fromstring`."""
+        bboxes = array("d")
+        for bbox in self.bboxes:
+            bboxes.extend(bbox)
+        return (POLYGONS_HEADER.pack(len(self), len(self.lats))
+                        + array("i", self.offsets).tostring()
+                        + array("d", self.lats).tostring()
+                        + array("d", self.lons).tostring()
+                        + bboxes.tostring())
+
+    @classmethod
+    def fromstring(cls, data, offset = 0):
+        """Unpack rings packed by `tostring` from `data` at `offset`.
+        Return the `Polygons` and the offset of the data following."""
+        if len(data) < offset + POLYGONS_HEADER.size:
+            raise ValueError, "Truncated data"
+        rings, points = POLYGONS_HEADER.unpack_from(data, offset)
+        offset += POLYGONS_HEADER.size
+        offsets, offset = _unpack_array("i", data, offset, rings + 1)
+        lats, offset = _unpack_array("d", data, offset, points)
+        lons, offset = _unpack_array("d", data, offset, points)
+        bbox_values, offset = _unpack_array("d", data, offset, rings * 4)
+        bboxes = [tuple(bbox_values[i:i + 4])
+                                    for i in range(0, len(bbox_values), 4)]
+        return cls(lats, lons, offsets, bboxes), offset
+
+    def edges(self):
+        """Iterate over (lat1, lon1, lat2, lon2) tuples of the edges
+        of all the rings."""
+        lats, lons, offsets = self.lats, self.lons, self.offsets
+        for ring in range(len(offsets) - 1):
+            start, end = offsets[ring], offsets[ring + 1]
+            for i in range(start, end):
+                if i > start:
+                    j = i - 1
+                else:
+                    j = end - 1
+                yield lats[i], lons[i], lats[j], lons[j]
+
+    @staticmethod
+    def _make_bands(lats, lons):
+        """Return (first band latitude, band height, edge lists) for
+        a ring. The edges are (lat1, lon1, lat2, lon2) tuples, the same as
+        used by the ray casting: from each point to the previous one."""
+        count = len(lats) // EDGES_PER_BAND + 1
+        lat0 = min(lats)
+        height = (max(lats) - lat0) / count
+        if height <= 0:
+            count, height = 1, 1.0
+        bands = [[] for i in range(count)]
+        for i in range(len(lats)):
+            edge = (lats[i], lons[i], lats[i - 1], lons[i - 1])
+            first = min(int((min(edge[0], edge[2]) - lat0) / height),
+                                                                count - 1)
+            last = min(int((max(edge[0], edge[2]) - lat0) / height),
+                                                                count - 1)
+            for band in range(first, last + 1):
+                bands[band].append(edge)
+        return lat0, height, bands
+
+    def _ring_bands(self, ring):
+        bands = self.bands[ring]
+        if bands is None:
+            start, end = self.offsets[ring], self.offsets[ring + 1]
+            bands = self._make_bands(self.lats[start:end],
+                                                    self.lons[start:end])
+            self.bands[ring] = bands
+        return bands
+
+    def _ring_contains(self, ring, lat, lon):
+        lat0, height, bands = self._ring_bands(ring)
+        band = min(int((lat - lat0) / height), len(bands) - 1)
+        contains = False
+        for lat1, lon1, lat2, lon2 in bands[band]:
+            if ( ((lat1 > lat) != (lat2 > lat)) and
+                    (lon < (lon2 - lon1) * (lat - lat1) / (lat2 - lat1) + lon1) ):
+                contains = not contains
+        return contains
+
+    def contains(self, lat, lon):
+        """Check if a point is inside any of the rings."""
+        if self.bbox is None:
+            return False
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+        for ring, (min_lat, min_lon, max_lat, max_lon) in enumerate(
+                                                                self.bboxes):
+            if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+                continue
+            if self._ring_contains(ring, lat, lon):
+                return True
+        return False
+
+    def _ring_edges(self, ring):
+        """Return the non-horizontal edges of a ring as (low latitude,
+        high latitude, lat1, lon1, lat2 - lat1, lon2 - lon1) tuples sorted
+        by the low latitude. Made when needed for the first time."""
+        edges = self.sorted_edges[ring]
+        if edges is None:
+            lats, lons = self.lats, self.lons
+            start, end = self.offsets[ring], self.offsets[ring + 1]
+            edges = []
+            for i in range(start, end):
+                if i > start:
+                    j = i - 1
+                else:
+                    j = end - 1
+                if lats[i] != lats[j]:
+                    edges.append((min(lats[i], lats[j]), max(lats[i], lats[j]),
+                                lats[i], lons[i],
+                                lats[j] - lats[i], lons[j] - lons[i]))
+            edges.sort()
+            self.sorted_edges[ring] = edges
+        return edges
+
+    def _ring_contains_many(self, ring, lats, lons, points):
+        """Return the subset of `points` (indices into `lats` and `lons`)
+        inside the ring. The points are swept in the order of latitude,
+        keeping the edges crossing the current latitude, so each edge
+        is visited once for all the points and each point is checked
+        only against the edges crossing its latitude."""
+        edges = self._ring_edges(ring)
+        inside = set()
+        active = {}
+        ends = []
+        next_edge = 0
+        edge_count = len(edges)
+        for i in sorted(points, key = lats.__getitem__):
+            lat = lats[i]
+            lon = lons[i]
+            while ends and ends[0][0] <= lat:
+                del active[heappop(ends)[1]]
+            while next_edge < edge_count and edges[next_edge][0] <= lat:
+                edge = edges[next_edge]
+                if edge[1] > lat:
+                    active[next_edge] = edge[2:]
+                    heappush(ends, (edge[1], next_edge))
+                next_edge += 1
+            contains = False
+            for lat1, lon1, d_lat, d_lon in active.itervalues():
+                if lon < d_lon * (lat - lat1) / d_lat + lon1:
+                    contains = not contains
+            if contains:
+                inside.add(i)
+        return inside
+
+    def contains_many(self, lats, lons):
+        """Return list of flags telling which of the points given by the
+        `lats` and `lons` sequences are inside any of the rings."""
+        lats = list(lats)
+        lons = list(lons)
+        result = [False] * len(lats)
+        if self.bbox is None:
+            return result
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        pending = [i for i in xrange(len(lats))
+                        if min_lat <= lats[i] <= max_lat
+                                    and min_lon <= lons[i] <= max_lon]
+        for ring, (min_lat, min_lon, max_lat, max_lon) in enumerate(
+                                                                self.bboxes):
+            if not pending:
+                break
+            points = [i for i in pending
+                        if min_lat <= lats[i] <= max_lat
+                                    and min_lon <= lons[i] <= max_lon]
+            if not points:
+                continue
+            inside = self._ring_contains_many(ring, lats, lons, points)
+            if not inside:
+                continue
+            for i in inside:
+                result[i] = True
+            pending = [i for i in pending if i not in inside]
+        return result
+
+class Area(object):
+    """`Polygons` of the outer rings with the `Polygons` of the inner
+    rings (holes) cut out."""
+    def __init__(self, outer, inner):
+        self.outer = outer
+        self.inner = inner
+        self.bbox = outer.bbox
+
+    def edges(self):
+        for edge in self.outer.edges():
+            yield edge
+        for edge in self.inner.edges():
+            yield edge
+
+    def contains(self, lat, lon):
+        return (self.outer.contains(lat, lon)
+                                and not self.inner.contains(lat, lon))
+
+    def contains_many(self, lats, lons):
+        result = self.outer.contains_many(lats, lons)
+        outer = [i for i, flag in enumerate(result) if flag]
+        in_hole = self.inner.contains_many([lats[i] for i in outer],
+                                                [lons[i] for i in outer])
+        for i, flag in izip(outer, in_hole):
+            if flag:
+                result[i] = False
+        return result
+
+class RasterMask(object):
+    """Labels (`OUTSIDE`, `INSIDE` or `EDGE`) of `rows`×`cols` cells
+    covering the bounding box `bbox`, in row (latitude) major order."""
+    def __init__(self, bbox, rows, cols, cells):
+        self.bbox = bbox
+        self.rows = rows
+        self.cols = cols
+        self.cells = cells
+        min_lat, min_lon, max_lat, max_lon = bbox
+        self.lat0 = min_lat
+        self.lon0 = min_lon
+        self.height = (max_lat - min_lat) / rows
+        if self.height <= 0:
+            self.height = 1.0
+        self.width = (max_lon - min_lon) / cols
+        if self.width <= 0:
+            self.width = 1.0
+
+    @classmethod
+    def build(cls, shape, size = MASK_SIZE):
+        """Compute the mask for `Polygons` or an `Area`."""
+        cells = array("b", [OUTSIDE]) * (size * size)
+        mask = cls(shape.bbox, size, size, cells)
+        for edge in shape.edges():
+            mask._mark_edge(*edge)
+        mask._fill(shape)
+        return mask
+
+    def _mark_edge(self, lat1, lon1, lat2, lon2):
+        """Label all the cells touched by an edge (with a small margin)
+        as `EDGE`."""
+        eps = 1e-6
+        x1 = (lon1 - self.lon0) / self.width
+        y1 = (lat1 - self.lat0) / self.height
+        x2 = (lon2 - self.lon0) / self.width
+        y2 = (lat2 - self.lat0) / self.height
+        if x1 > x2:
+            x1, y1, x2, y2 = x2, y2, x1, y1
+        first_col = max(int(math.floor(x1 - eps)), 0)
+        last_col = min(int(math.floor(x2 + eps)), self.cols - 1)
+        for col in range(first_col, last_col + 1):
+            if x2 > x1:
+                t1 = max(0.0, (col - eps - x1) / (x2 - x1))
+                t2 = min(1.0, (col + 1 + eps - x1) / (x2 - x1))
+                ya = y1 + (y2 - y1) * t1
+                yb = y1 + (y2 - y1) * t2
+            else:
+                ya, yb = y1, y2
+            first_row = max(int(math.floor(min(ya, yb) - eps)), 0)
+            last_row = min(int(math.floor(max(ya, yb) + eps)), self.rows - 1)
+            for row in range(first_row, last_row + 1):
+                self.cells[row * self.cols + col] = EDGE
+
+    def _fill(self, shape):
+        """Label the cells not crossed by any edge. Cells between two
+        edge cells of a row are all inside or all outside, so only one
+        of them is checked."""
+        edge = chr(EDGE)
+        for row in range(self.rows):
+            offset = row * self.cols
+            labels = self.cells[offset:offset + self.cols].tostring()
+            lat = self.lat0 + (row + 0.5) * self.height
+            col = 0
+            while col < self.cols:
+                end = labels.find(edge, col)
+                if end < 0:
+                    end = self.cols
+                if end > col:
+                    lon = self.lon0 + (col + 0.5) * self.width
+                    if shape.contains(lat, lon):
+                        self.cells[offset + col:offset + end] = (
+                                            array("b", [INSIDE]) * (end - col))
+                col = end + 1
+
+    def lookup(self, lat, lon):
+        """Return label of the cell containing a point."""
+        row = int((lat - self.lat0) / self.height)
+        col = int((lon - self.lon0) / self.width)
+        if lat < self.lat0 or lon < self.lon0:
+            return OUTSIDE
+        if row >= self.rows or col >= self.cols:
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            if lat > max_lat or lon > max_lon:
+                return OUTSIDE
+            row = min(row, self.rows - 1)
+            col = min(col, self.cols - 1)
+        return self.cells[row * self.cols + col]
+
+    def lookup_many(self, lats, lons):
+        """Return list of labels of the cells containing the points."""
+        return [self.lookup(lat, lon) for lat, lon in izip(lats, lons)]
+
+    def write(self, filename, source):
+        """Write the mask to a file, with the signature of the `source`
+        file of the rings."""
+        tmp_filename = filename + ".tmp"
+        stream = open(tmp_filename, "wb")
+        try:
+            stream.write(MASK_MAGIC)
+            stream.write(SOURCE_SIGNATURE.pack(*file_signature(source)))
+            stream.write(MASK_HEADER.pack(self.rows, self.cols, *self.bbox))
+            stream.write(self.cells.tostring())
+        finally:
+            stream.close()
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def read(cls, filename, source):
+        """Read mask written by `write`. Return `None` if the file
+        does not exist or does not match the `source` file."""
+        if not os.path.exists(filename):
+            return None
+        stream = open(filename, "rb")
+        try:
+            data = stream.read()
+        finally:
+            stream.close()
+        header_size = (len(MASK_MAGIC) + SOURCE_SIGNATURE.size
+                                                        + MASK_HEADER.size)
+        if len(data) < header_size or not data.startswith(MASK_MAGIC):
+            return None
+        if not source_matches(data, len(MASK_MAGIC), source):
+            return None
+        header = MASK_HEADER.unpack_from(data,
+                                    len(MASK_MAGIC) + SOURCE_SIGNATURE.size)
+        rows, cols, bbox = header[0], header[1], header[2:]
+        if len(data) != header_size + rows * cols:
+            return None
+        cells = array("b")
+        cells.fromstring(data[header_size:])
+        return cls(bbox, rows, cols, cells)
+
+def mask_filename(source):
+    return source + ".mask"
+
+def load_raster_mask(source, shape, size = MASK_SIZE):
+    """Return `RasterMask` of `shape` read from `source`, loading
+    it from the file next to `source` or computing and storing it.
+    The mask is still returned when it cannot be stored."""
+    filename = mask_filename(source)
+    mask = RasterMask.read(filename, source)
+    if mask is not None and mask.rows == size and mask.cols == size:
+        return mask
+    mask = RasterMask.build(shape, size)
+    try:
+        mask.write(filename, source)
+    except (IOError, OSError), err:
+        Reporting().output_msg("errors", u"Nie można zapisać maski %s: %s"
+                        % (filename, str(err).decode("utf-8", "replace")))
+    return mask
@@ -104,7 +104,7 @@ class Channel(object):
         self.log_file.write(u"%s\n" % (msg,))
         if self.map_file and isinstance(location, OSM_Place):
             self.map_file.write(
-                    ElementTree.tostring(location.element, "utf-8"))
+                    ElementTree.tostring(location.to_element(), "utf-8"))
         if not self.split_level:
             return
         try:
@@ -229,10 +229,14 @@ class Reporting(object):
             raise ProgressError, u"Progress reporting not started."
         if not self.progress_total:
             return
-        if increment is not None:
-            self.progress_value += increment
-        elif value is not None:
-            self.progress_value = value
+        if increment is not None or value is not None:
+            old_step = self.progress_value / self.progress_step
+            if increment is not None:
+                self.progress_value += increment
+            else:
+                self.progress_value = value
+            if self.progress_value / self.progress_step == old_step:
+                return
         else:
             self.progress_value += 1
             if self.progress_value % self.progress_step:
@@ -0,0 +1,97 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""
+Index of OSM places for the reverse ambiguity check of a match.
+
+An OSM place conflicts with a match of another OSM place to a SIMC place
+when it has the same name, is in the same grid cell and its gmina, powiat
+and województwo are either unknown or the same as of the SIMC place.
+The index keeps the OSM places by (name, cell, województwo, powiat, gmina),
+so the conflicting places are found with eight lookups.
+"""
+
+__version__ = "$Revision$"
+
+from itertools import izip
+from teryt2osm.grid import NO_LOCATION, location_index
+from teryt2osm.osm_places import OSM_Place
+
+class ReverseIndex(object):
+    """The index for OSM places with names and a `teryt2osm.grid.Grid`
+    (or no grid at all)."""
+    def __init__(self, grid = None):
+        self.grid = grid
+        self.places = {}
+        self.keys = {}
+        names = []
+        places = []
+        positions = []
+        for name, same_name in OSM_Place._by_name.items():
+            for pos, place in enumerate(same_name):
+                names.append(name)
+                places.append(place)
+                positions.append(pos)
+        if grid:
+            cells = grid.get_cells(places)
+        else:
+            cells = [None] * len(places)
+        for name, place, pos, cell in izip(names, places, positions, cells):
+            self._add(place, (name, self._cell_key(cell)), pos)
+
+    @staticmethod
+    def _cell_key(cell):
+        if cell is None:
+            return None
+        return (cell.x, cell.y)
+
+    def _add(self, place, prefix, pos):
+        key = prefix + (location_index(place.wojewodztwo),
+                location_index(place.powiat), location_index(place.gmina))
+        self.places.setdefault(key, []).append((pos, place))
+        self.keys[id(place)] = key
+
+    def update(self, place):
+        """Move a place whose location has changed."""
+        key = self.keys.get(id(place))
+        if key is None:
+            return
+        same_key = self.places[key]
+        for i, (pos, indexed) in enumerate(same_key):
+            if indexed is place:
+                del same_key[i]
+                break
+        self._add(place, key[:2], pos)
+
+    def conflicts(self, osm_place, simc_place, cell = None):
+        """Return the OSM places, other than `osm_place`, conflicting with
+        matching it to the `simc_place`, in the `OSM_Place.by_name` order.
+        `cell` is the grid cell of `osm_place`."""
+        prefix = (simc_place.name.lower(), self._cell_key(cell))
+        woj = location_index(simc_place.wojewodztwo)
+        pow = location_index(simc_place.powiat)
+        gmi = location_index(simc_place.gmina)
+        result = []
+        for woj_key in (NO_LOCATION, woj):
+            for pow_key in (NO_LOCATION, pow):
+                for gmi_key in (NO_LOCATION, gmi):
+                    key = prefix + (woj_key, pow_key, gmi_key)
+                    result += self.places.get(key, [])
+        result.sort()
+        return [place for pos, place in result if place is not osm_place]
@@ -20,10 +20,14 @@
 __version__ = "$Revision$"
 
 import os
+import itertools
+import multiprocessing
 import xml.etree.cElementTree as ElementTree
-from teryt2osm.utils import add_to_list_dict, count_elements
+from teryt2osm.utils import add_to_list_dict, ProgressFile, iter_elements
+from teryt2osm.utils import intern_string, split_xml, read_xml_range
 from teryt2osm.terc import Wojewodztwo, Powiat, Gmina, load_terc
 from teryt2osm.reporting import Reporting
+from teryt2osm.snapshot import load_snapshot, save_snapshot
 
 simc2place_mapping = {
         u"wieś": "village",
@@ -52,12 +56,11 @@ def parse_simc(value):
     int(value)
     return value
 
-def load_wmrodz():
-    reporting = Reporting()
-    reporting.output_msg("info", u"Ładowanie data/WMRODZ.xml")
-    tree = ElementTree.parse("data/WMRODZ.xml")
-    root = tree.getroot()
+def parse_wmrodz_rows(filename):
+    """Read (RM, NAZWA_RM) pairs from the WMRODZ catalog."""
+    tree = ElementTree.parse(filename)
     catalog = tree.find("catalog")
+    rows = []
     for row in catalog:
         if row.tag != "row":
             continue
@@ -72,9 +75,25 @@ def load_wmrodz():
             elif key == "NAZWA_RM":
                 nazwa = col.text.strip()
         if rm and nazwa:
-            wmrodz[rm] = nazwa
-            if nazwa in simc2place_mapping:
-                rm2place_mapping[rm] = simc2place_mapping[nazwa]
+            rows.append((rm, nazwa))
+    return rows
+
+def load_wmrodz(use_snapshot = True):
+    reporting = Reporting()
+    rows = None
+    if use_snapshot:
+        rows = load_snapshot("data/WMRODZ.xml")
+    if rows is not None:
+        reporting.output_msg("info", u"Ładowanie data/WMRODZ.xml z kopii podręcznej")
+    else:
+        reporting.output_msg("info", u"Ładowanie data/WMRODZ.xml")
+        rows = parse_wmrodz_rows("data/WMRODZ.xml")
+        if use_snapshot:
+            save_snapshot("data/WMRODZ.xml", rows)
+    for rm, nazwa in rows:
+        wmrodz[rm] = nazwa
+        if nazwa in simc2place_mapping:
+            rm2place_mapping[rm] = simc2place_mapping[nazwa]
 
 def write_wmrodz_wiki():
     import locale, codecs
@@ -98,57 +117,161 @@ def write_wmrodz_wiki():
     wiki_file.close()
 
 class SIMC_Place(object):
+    __slots__ = ("rm", "type", "name", "gmina", "id", "parent", "parent_id",
+                                                        "date", "osm_place")
     _by_id = {}
     _by_type = {}
     _by_name = {}
-    def __init__(self, rm, name, terc_id, place_id, parent_id, date):
-        self.rm = rm
+    # places not assigned to any OSM place yet, by (lower-case name, type),
+    # (lower-case name, type, powiat index) and (lower-case name, type,
+    # gmina index)
+    _candidates = {}
+    _candidates_by_powiat = {}
+    _candidates_by_gmina = {}
+    _store = None
+    def __init__(self, rm, name, terc_id, place_id, parent_id, date,
+                                                            register = True):
+        self.rm = intern_string(rm)
         place_type = rm2place_mapping[rm]
         self.type = place_type
         self.name = name
-        self.terc_id = terc_id
         self.gmina = Gmina.by_code(terc_id)
-        self.powiat = self.gmina.powiat
-        self.wojewodztwo = self.powiat.wojewodztwo
         self.id = place_id
         self.parent = None
         if parent_id and parent_id != place_id:
             self.parent_id = parent_id
         else:
             self.parent_id = None
-        self.date = date
-        self._by_id[place_id] = self
-        add_to_list_dict(self._by_type, place_type, self)
-        add_to_list_dict(self._by_name, name.lower(), self)
+        self.date = intern_string(date)
         self.osm_place = None
+        if register:
+            self.register()
+
+    def register(self):
+        """Add the place to the class-level indexes."""
+        self._by_id[self.id] = self
+        add_to_list_dict(self._by_type, self.type, self)
+        add_to_list_dict(self._by_name, self.name.lower(), self)
+        if self.osm_place is None:
+            for index, key in self._candidate_keys():
+                add_to_list_dict(index, key, self)
+
+    def _candidate_keys(self):
+        key = (self.name.lower(), self.type)
+        return [(self._candidates, key),
+                (self._candidates_by_powiat, key + (self.powiat.index,)),
+                (self._candidates_by_gmina, key + (self.gmina.index,))]
+
+    @property
+    def terc_id(self):
+        return self.gmina.code
+
+    @property
+    def powiat(self):
+        return self.gmina.powiat
+
+    @property
+    def wojewodztwo(self):
+        return self.gmina.wojewodztwo
+
+    @classmethod
+    def use_store(cls, store):
+        """Use a `teryt2osm.simc_store.SIMC_Store` instead of the in-memory
+        dictionaries for the place lookups."""
+        cls._store = store
 
     @classmethod
     def by_id(cls, place_id):
         """Return single place identified by a SIMC id."""
+        if cls._store is not None:
+            return cls._store.by_id(place_id)
         return cls._by_id[place_id]
 
     @classmethod
     def by_name(cls, name):
         """Return all places matching a name."""
+        if cls._store is not None:
+            return cls._store.by_name(name)
         return cls._by_name[name.lower()]
 
     @classmethod
     def by_type(cls, place_type):
         """Return all places of given type."""
+        if cls._store is not None:
+            return cls._store.by_type(place_type)
         return cls._by_type[place_type]
 
+    @classmethod
+    def find(cls, name, place_type, powiaty = None, gminy = None):
+        """Return places matching a name and type, not assigned to any OSM
+        place yet. Raise KeyError when there is no place of that name
+        at all.
+
+        `powiaty` and `gminy` are optional `teryt2osm.grid.LocationSet`
+        objects, the places must be in one of the units given."""
+        if cls._store is not None:
+            return cls._store.find(name, place_type, powiaty, gminy)
+        name = name.lower()
+        if name not in cls._by_name:
+            raise KeyError, name
+        key = (name, place_type)
+        if gminy is not None:
+            index, units = cls._candidates_by_gmina, gminy
+        elif powiaty is not None:
+            index, units = cls._candidates_by_powiat, powiaty
+        else:
+            return list(cls._candidates.get(key, []))
+        lists = [index[key + (i,)] for i in units.indices
+                                                if key + (i,) in index]
+        if not lists:
+            return []
+        elif len(lists) == 1:
+            places = list(lists[0])
+        else:
+            order = dict([(id(p), i)
+                            for i, p in enumerate(cls._candidates[key])])
+            places = sum(lists, [])
+            places.sort(key = lambda p: order[id(p)])
+        if gminy is not None and powiaty is not None:
+            places = [p for p in places if p.powiat in powiaty]
+        return places
+
+    @classmethod
+    def all_names(cls):
+        """Return lower-case names of all the places, each one once."""
+        if cls._store is not None:
+            return cls._store.all_names()
+        return cls._by_name.keys()
+
     @classmethod
     def link_parents(cls):
+        if cls._store is not None:
+            cls._store.link_parents()
+            return
         for place in cls._by_id.values():
             if place.parent_id:
                 place.parent = cls._by_id.get(place.parent_id)
 
     @classmethod
     def count(cls):
+        if cls._store is not None:
+            return cls._store.count()
         return len(cls._by_id.items())
 
     @classmethod
-    def from_element(cls, element):
+    def all(cls):
+        if cls._store is not None:
+            return cls._store.all()
+        return cls._by_id.values()
+
+    @staticmethod
+    def parse_row(element):
+        """Extract column values from a SIMC.xml row element.
+
+        Return (woj_code, pow_code, gmi_code, gmi_type, rm, name, place_id,
+        parent_id, date) tuple."""
+        woj_code = pow_code = gmi_code = gmi_type = rm = None
+        name = place_id = parent_id = date = None
         for child in element:
             if child.tag != 'col':
                 continue
@@ -163,8 +286,6 @@ class SIMC_Place(object):
                 gmi_type = child.text
             elif key == "RM":
                 rm = child.text
-            elif key == "MZ":
-                mz = child.text
             elif key == "NAZWA":
                 name = child.text
             elif key == "SYM":
@@ -173,13 +294,29 @@ class SIMC_Place(object):
                 parent_id = child.text
             elif key == "STAN_NA":
                 date = child.text
+        return (woj_code, pow_code, gmi_code, gmi_type, rm, name, place_id,
+                                                            parent_id, date)
+
+    @classmethod
+    def from_row(cls, row):
+        """Create a place from a row returned by `parse_row`."""
+        (woj_code, pow_code, gmi_code, gmi_type, rm, name, place_id,
+                                                    parent_id, date) = row
         if rm not in rm2place_mapping:
             return None
         code = woj_code + pow_code + gmi_code + gmi_type
         return cls(rm, name, code, place_id, parent_id, date)
+
+    @classmethod
+    def from_element(cls, element):
+        return cls.from_row(cls.parse_row(element))
     
     def assign_osm(self, osm_place):
         """Assigning a OSM place"""
+        if (self.osm_place is None and osm_place is not None
+                                and self._by_id.get(self.id) is self):
+            for index, key in self._candidate_keys():
+                index[key].remove(self)
         self.osm_place = osm_place
 
     def __repr__(self):
@@ -190,16 +327,98 @@ class SIMC_Place(object):
         return u"%s, %s, %s, %s" % (self.name, self.gmina.name, 
                                     powiat.full_name(), wojewodztwo.full_name())
 
-def load_simc():
-    load_wmrodz()
+def filter_places(places, powiaty = None, gminy = None):
+    """Return places in one of the `powiaty` and one of the `gminy`.
+    For the `SIMC_Place.find` implementations."""
+    if powiaty is not None:
+        places = [p for p in places if p.powiat in powiaty]
+    if gminy is not None:
+        places = [p for p in places if p.gmina in gminy]
+    return places
+
+def parse_simc_range(args):
+    """Parse SIMC rows from a byte range of the file.
+    Executed in the worker processes of `parse_simc_parallel`."""
+    filename, start, end = args
+    stream = read_xml_range(filename, start, end)
+    return [SIMC_Place.parse_row(elem) for elem in iter_elements(stream, "row")]
+
+def parse_simc_parallel(filename, processes):
+    """Parse the SIMC file in `processes` worker processes.
+
+    The file is split on the <row> boundaries into byte ranges, which are
+    parsed independently. Yield lists of rows (as returned by
+    `SIMC_Place.parse_row`) in the file order."""
     reporting = Reporting()
-    row_count = count_elements("data/SIMC.xml", "row")
-    reporting.progress_start(u"Ładowanie data/SIMC.xml", row_count)
-    for event, elem in ElementTree.iterparse("data/SIMC.xml"):
-        if event == 'end' and elem.tag == 'row':
-            SIMC_Place.from_element(elem)
-            reporting.progress()
+    ranges = split_xml(filename, "row", processes * 4)
+    total = sum([end - start for start, end in ranges])
+    reporting.progress_start(u"Ładowanie %s (%i procesów)"
+                                    % (filename, processes), total)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.imap(parse_simc_range,
+                        [(filename, start, end) for start, end in ranges])
+        for (start, end), rows in itertools.izip(ranges, results):
+            yield rows
+            reporting.progress(end - start)
+    finally:
+        pool.terminate()
+        pool.join()
     reporting.progress_stop()
+
+def load_simc(use_snapshot = True, columnar = False, processes = 1,
+                                        rows = None, from_snapshot = False):
+    """Load the SIMC catalog. When `columnar` is True the places are stored
+    in a `teryt2osm.simc_store.SIMC_Store` instead of `SIMC_Place`
+    objects. With `processes` > 1 the XML file is parsed in parallel.
+    If `rows` is given, it should be a list of rows returned by
+    `SIMC_Place.parse_row` and the file is not parsed again.
+    `from_snapshot` tells the rows were loaded from the snapshot."""
+    load_wmrodz(use_snapshot)
+    reporting = Reporting()
+    if columnar:
+        from teryt2osm.simc_store import SIMC_Store
+        store = SIMC_Store()
+        add_row = store.add_row
+        SIMC_Place.use_store(store)
+    else:
+        add_row = SIMC_Place.from_row
+    if rows is None and use_snapshot:
+        rows = load_snapshot("data/SIMC.xml")
+        from_snapshot = rows is not None
+    if rows is not None and from_snapshot:
+        reporting.progress_start(
+                u"Ładowanie data/SIMC.xml z kopii podręcznej", len(rows))
+        for row in rows:
+            add_row(row)
+            reporting.progress()
+        reporting.progress_stop()
+    elif rows is not None:
+        for row in rows:
+            add_row(row)
+        if use_snapshot:
+            save_snapshot("data/SIMC.xml", rows)
+    elif processes > 1:
+        rows = []
+        for chunk_rows in parse_simc_parallel("data/SIMC.xml", processes):
+            for row in chunk_rows:
+                add_row(row)
+            rows += chunk_rows
+        if use_snapshot:
+            save_snapshot("data/SIMC.xml", rows)
+    else:
+        rows = []
+        stream = ProgressFile("data/SIMC.xml")
+        try:
+            reporting.progress_start(u"Ładowanie data/SIMC.xml", stream.size)
+            for elem in iter_elements(stream, "row"):
+                row = SIMC_Place.parse_row(elem)
+                add_row(row)
+                rows.append(row)
+            reporting.progress_stop()
+        finally:
+            stream.close()
+        if use_snapshot:
+            save_snapshot("data/SIMC.xml", rows)
     reporting.output_msg("stats", u"Załadowano %i miejscowości" % (SIMC_Place.count(),))
     SIMC_Place.link_parents()
-
@@ -0,0 +1,283 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Column-oriented storage of the SIMC catalog.
+
+Every catalog column is kept in a separate `array.array`, strings are
+stored once in a string pool and referenced by their offsets. Indexes
+are arrays of row numbers sorted by the key column, searched with
+`bisect`. Rows are exposed as lightweight `SIMC_Record` views with the same
+attributes as `SIMC_Place`."""
+
+__version__ = "$Revision$"
+
+from array import array
+from bisect import bisect_left, bisect_right
+from teryt2osm.terc import Gmina
+from teryt2osm.simc import rm2place_mapping, filter_places
+
+class StringPool(object):
+    """Store each distinct string once and refer to it by its offset."""
+    def __init__(self):
+        self.strings = []
+        self.offsets = {}
+
+    def add(self, value):
+        offset = self.offsets.get(value)
+        if offset is None:
+            offset = len(self.strings)
+            self.strings.append(value)
+            self.offsets[value] = offset
+        return offset
+
+    def __getitem__(self, offset):
+        return self.strings[offset]
+
+    def __len__(self):
+        return len(self.strings)
+
+class SIMC_Record(object):
+    """A view of a single `SIMC_Store` row."""
+    __slots__ = ("store", "index")
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def id(self):
+        return "%07i" % (self.store.ids[self.index],)
+
+    @property
+    def name(self):
+        return self.store.names[self.store.name_offsets[self.index]]
+
+    @property
+    def rm(self):
+        return self.store.rms[self.store.rm_offsets[self.index]]
+
+    @property
+    def type(self):
+        return self.store.types[self.store.type_offsets[self.index]]
+
+    @property
+    def date(self):
+        return self.store.dates[self.store.date_offsets[self.index]]
+
+    @property
+    def gmina(self):
+        return self.store.gminy[self.store.gmina_offsets[self.index]]
+
+    @property
+    def powiat(self):
+        return self.gmina.powiat
+
+    @property
+    def wojewodztwo(self):
+        return self.gmina.wojewodztwo
+
+    @property
+    def terc_id(self):
+        return self.gmina.code
+
+    @property
+    def parent_id(self):
+        parent_id = self.store.parent_ids[self.index]
+        if parent_id:
+            return "%07i" % (parent_id,)
+        else:
+            return None
+
+    @property
+    def parent(self):
+        parent = self.store.parents[self.index]
+        if parent < 0:
+            return None
+        return SIMC_Record(self.store, parent)
+
+    @property
+    def osm_place(self):
+        return self.store.osm_places.get(self.index)
+
+    def assign_osm(self, osm_place):
+        """Assigning a OSM place"""
+        self.store.osm_places[self.index] = osm_place
+
+    def __eq__(self, other):
+        return (isinstance(other, SIMC_Record) and other.store is self.store
+                                            and other.index == self.index)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.index)
+
+    def __repr__(self):
+        return "<SIMC_Place #%s %r>" % (self.id, self.name)
+
+    def __unicode__(self):
+        powiat = self.gmina.powiat
+        wojewodztwo = self.gmina.wojewodztwo
+        return u"%s, %s, %s, %s" % (self.name, self.gmina.name,
+                                    powiat.full_name(), wojewodztwo.full_name())
+
+class SIMC_Store(object):
+    """SIMC catalog kept in parallel column arrays."""
+    def __init__(self):
+        self.ids = array("l")
+        self.parent_ids = array("l")
+        self.parents = array("l")
+        self.rm_offsets = array("H")
+        self.type_offsets = array("H")
+        self.date_offsets = array("H")
+        self.gmina_offsets = array("H")
+        self.name_offsets = array("l")
+        self.rms = StringPool()
+        self.types = StringPool()
+        self.dates = StringPool()
+        self.names = StringPool()
+        self.gminy = []
+        self._gmina_offsets = {}
+        self.osm_places = {}
+        self.id_keys = None
+        self.id_index = None
+        self.lower_names = None
+        self.name_keys = None
+        self.name_index = None
+        self.type_keys = None
+        self.type_index = None
+
+    def add_row(self, row):
+        """Add a row returned by `SIMC_Place.parse_row`.
+        Rows of types not handled by teryt2osm are ignored."""
+        (woj_code, pow_code, gmi_code, gmi_type, rm, name, place_id,
+                                                    parent_id, date) = row
+        if rm not in rm2place_mapping:
+            return None
+        terc_id = woj_code + pow_code + gmi_code + gmi_type
+        gmina_offset = self._gmina_offsets.get(terc_id)
+        if gmina_offset is None:
+            gmina = Gmina.by_code(terc_id)
+            gmina_offset = len(self.gminy)
+            self.gminy.append(gmina)
+            self._gmina_offsets[terc_id] = gmina_offset
+        index = len(self.ids)
+        self.ids.append(int(place_id))
+        if parent_id and parent_id != place_id:
+            self.parent_ids.append(int(parent_id))
+        else:
+            self.parent_ids.append(0)
+        self.rm_offsets.append(self.rms.add(rm))
+        self.type_offsets.append(self.types.add(rm2place_mapping[rm]))
+        self.date_offsets.append(self.dates.add(date))
+        self.gmina_offsets.append(gmina_offset)
+        self.name_offsets.append(self.names.add(name))
+        return index
+
+    def link_parents(self):
+        """Build the indexes and resolve parent references.
+        Must be called after all the rows are added."""
+        count = len(self.ids)
+        ids = self.ids
+        order = sorted(xrange(count), key = ids.__getitem__)
+        self.id_index = array("l", order)
+        self.id_keys = array("l", [ids[i] for i in order])
+
+        lower_names = sorted(set([n.lower() for n in self.names.strings]))
+        ranks = dict([(n, i) for i, n in enumerate(lower_names)])
+        name_ranks = [ranks[n.lower()] for n in self.names.strings]
+        row_ranks = [name_ranks[o] for o in self.name_offsets]
+        order = sorted(xrange(count), key = row_ranks.__getitem__)
+        self.lower_names = lower_names
+        self.name_index = array("l", order)
+        self.name_keys = array("l", [row_ranks[i] for i in order])
+
+        type_offsets = self.type_offsets
+        order = sorted(xrange(count), key = type_offsets.__getitem__)
+        self.type_index = array("l", order)
+        self.type_keys = array("H", [type_offsets[i] for i in order])
+
+        self._gmina_offsets = {}
+        parents = array("l", [-1]) * count
+        for i in xrange(count):
+            parent_id = self.parent_ids[i]
+            if parent_id:
+                parents[i] = self._find_id(parent_id)
+        self.parents = parents
+
+    def _find_id(self, place_id):
+        pos = bisect_left(self.id_keys, place_id)
+        if pos < len(self.id_keys) and self.id_keys[pos] == place_id:
+            return self.id_index[pos]
+        return -1
+
+    def _name_range(self, name):
+        name = name.lower()
+        rank = bisect_left(self.lower_names, name)
+        if rank >= len(self.lower_names) or self.lower_names[rank] != name:
+            raise KeyError, name
+        start = bisect_left(self.name_keys, rank)
+        end = bisect_right(self.name_keys, rank, start)
+        return self.name_index[start:end]
+
+    def by_id(self, place_id):
+        """Return single place identified by a SIMC id."""
+        try:
+            index = self._find_id(int(place_id))
+        except ValueError:
+            raise KeyError, place_id
+        if index < 0:
+            raise KeyError, place_id
+        return SIMC_Record(self, index)
+
+    def by_name(self, name):
+        """Return all places matching a name."""
+        return [SIMC_Record(self, i) for i in self._name_range(name)]
+
+    def all_names(self):
+        """Return lower-case names of all the places, each one once."""
+        return self.lower_names
+
+    def by_type(self, place_type):
+        """Return all places of given type."""
+        offset = self.types.offsets.get(place_type)
+        if offset is None:
+            raise KeyError, place_type
+        start = bisect_left(self.type_keys, offset)
+        end = bisect_right(self.type_keys, offset, start)
+        return [SIMC_Record(self, i) for i in self.type_index[start:end]]
+
+    def find(self, name, place_type, powiaty = None, gminy = None):
+        """Return places matching a name and type, not assigned to any OSM
+        place yet, optionally only in given powiaty and gminy."""
+        type_offset = self.types.offsets.get(place_type)
+        if type_offset is None:
+            return []
+        type_offsets = self.type_offsets
+        osm_places = self.osm_places
+        return filter_places([SIMC_Record(self, i)
+                    for i in self._name_range(name)
+                    if type_offsets[i] == type_offset and i not in osm_places],
+                                                            powiaty, gminy)
+
+    def all(self):
+        return [SIMC_Record(self, i) for i in xrange(len(self.ids))]
+
+    def count(self):
+        return len(self.ids)
@@ -0,0 +1,100 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""Binary snapshots of the parsed catalog rows.
+
+A snapshot keeps the rows extracted from a source XML file, so the
+registries can be rebuilt without parsing the XML again. Each snapshot
+is stored together with the size, modification time and MD5 sum
+of the source file and is ignored when the source file changes."""
+
+__version__ = "$Revision$"
+
+import os
+import hashlib
+import cPickle as pickle
+
+SNAPSHOT_DIR = "cache"
+SNAPSHOT_FORMAT = 1
+
+def file_md5(filename):
+    """Compute MD5 sum of a file contents."""
+    md5 = hashlib.md5()
+    stream = open(filename, "rb")
+    try:
+        while True:
+            data = stream.read(1024 * 1024)
+            if not data:
+                break
+            md5.update(data)
+    finally:
+        stream.close()
+    return md5.hexdigest()
+
+def file_signature(filename, md5 = None):
+    """Return (size, mtime, md5) tuple describing a file."""
+    stat = os.stat(filename)
+    if md5 is None:
+        md5 = file_md5(filename)
+    return (stat.st_size, stat.st_mtime, md5)
+
+def snapshot_filename(source):
+    return os.path.join(SNAPSHOT_DIR, os.path.basename(source) + ".snapshot")
+
+def load_snapshot(source):
+    """Load rows stored for the `source` file.
+
+    Return `None` when there is no snapshot or it does not match the current
+    source file contents."""
+    filename = snapshot_filename(source)
+    if not os.path.exists(filename):
+        return None
+    stream = open(filename, "rb")
+    try:
+        try:
+            unpickler = pickle.Unpickler(stream)
+            if unpickler.load() != SNAPSHOT_FORMAT:
+                return None
+            size, mtime, md5 = unpickler.load()
+            stat = os.stat(source)
+            if stat.st_size != size:
+                return None
+            if stat.st_mtime != mtime and file_md5(source) != md5:
+                return None
+            return unpickler.load()
+        except (EOFError, ValueError, pickle.UnpicklingError):
+            return None
+    finally:
+        stream.close()
+
+def save_snapshot(source, rows):
+    """Store rows read from the `source` file."""
+    if not os.path.exists(SNAPSHOT_DIR):
+        os.mkdir(SNAPSHOT_DIR)
+    filename = snapshot_filename(source)
+    tmp_filename = filename + ".tmp"
+    stream = open(tmp_filename, "wb")
+    try:
+        pickler = pickle.Pickler(stream, pickle.HIGHEST_PROTOCOL)
+        pickler.dump(SNAPSHOT_FORMAT)
+        pickler.dump(file_signature(source))
+        pickler.dump(rows)
+    finally:
+        stream.close()
+    os.rename(tmp_filename, filename)
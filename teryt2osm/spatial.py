@@ -0,0 +1,222 @@
+# vi: encoding=utf-8
+
+# teryt2osm - tool to merge TERYT data with OSM maps
+# Copyright (C) 2009 Jacek Konieczny <jajcus@jajcus.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+"""
+Spatial index of places.
+
+`SpatialIndex` is a 2-d tree of places, answering radius and nearest
+neighbour queries in kilometers. `RadiusGrid` uses it in place of
+`teryt2osm.grid.Grid`: the 'cell' of a place is its neighbourhood
+of a given radius.
+"""
+
+__version__ = "$Revision$"
+
+import math
+import heapq
+from operator import itemgetter
+from teryt2osm.grid import Cell
+from teryt2osm.reporting import Reporting
+
+KM_PER_DEGREE_LAT = 110.57
+KM_PER_DEGREE_LON = 111.32
+
+class KDTree(object):
+    """2-d tree of (x, y, item) points."""
+    def __init__(self, points):
+        self.size = len(points)
+        self.root = self._build(list(points), 0)
+
+    def _build(self, points, axis):
+        if not points:
+            return None
+        points.sort(key = itemgetter(axis))
+        median = len(points) // 2
+        return (points[median], axis,
+                        self._build(points[:median], 1 - axis),
+                        self._build(points[median + 1:], 1 - axis))
+
+    def within(self, x, y, radius):
+        """Return items of the points not further than `radius` from
+        (x, y)."""
+        result = []
+        radius2 = radius * radius
+        query = (x, y)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            point, axis, left, right = node
+            dx = point[0] - x
+            dy = point[1] - y
+            if dx * dx + dy * dy <= radius2:
+                result.append(point[2])
+            diff = query[axis] - point[axis]
+            if diff <= radius:
+                stack.append(left)
+            if diff >= -radius:
+                stack.append(right)
+        return result
+
+    def nearest(self, x, y, k = 1):
+        """Return (distance, item) pairs of up to `k` points nearest
+        to (x, y), the nearest first."""
+        heap = []
+        query = (x, y)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            point, axis, left, right = node
+            dx = point[0] - x
+            dy = point[1] - y
+            dist2 = dx * dx + dy * dy
+            if len(heap) < k:
+                heapq.heappush(heap, (-dist2, id(point), point[2]))
+            elif dist2 < -heap[0][0]:
+                heapq.heapreplace(heap, (-dist2, id(point), point[2]))
+            diff = query[axis] - point[axis]
+            if diff <= 0:
+                near, far = left, right
+            else:
+                near, far = right, left
+            if len(heap) < k or diff * diff < -heap[0][0]:
+                stack.append(far)
+            # visited first
+            stack.append(near)
+        heap.sort(reverse = True)
+        return [(math.sqrt(-d), item) for d, i, item in heap]
+
+class SpatialIndex(object):
+    """Index of places (objects with `lon` and `lat` attributes)."""
+    def __init__(self, places):
+        reporting = Reporting()
+        places = list(places)
+        reporting.progress_start(u"Creating spatial index of %i places"
+                                                % (len(places),), len(places))
+        if places:
+            lat0 = sum([p.lat for p in places]) / len(places)
+        else:
+            lat0 = 0.0
+        self.lon_scale = KM_PER_DEGREE_LON * math.cos(math.radians(lat0))
+        self.lat_scale = KM_PER_DEGREE_LAT
+        points = []
+        for place in places:
+            reporting.progress()
+            x, y = self.project(place.lon, place.lat)
+            points.append((x, y, place))
+        self.tree = KDTree(points)
+        if points:
+            xs = [p[0] for p in points]
+            ys = [p[1] for p in points]
+            self.width = max(xs) - min(xs)
+            self.height = max(ys) - min(ys)
+        else:
+            self.width = self.height = 0.0
+        reporting.progress_stop()
+
+    def __len__(self):
+        return self.tree.size
+
+    def project(self, lon, lat):
+        """Convert coordinates to kilometers on a plane."""
+        return lon * self.lon_scale, lat * self.lat_scale
+
+    def distance(self, place, other):
+        """Distance between two places in kilometers."""
+        x1, y1 = self.project(place.lon, place.lat)
+        x2, y2 = self.project(other.lon, other.lat)
+        return math.hypot(x2 - x1, y2 - y1)
+
+    def within(self, place, radius):
+        """Return indexed places not further than `radius` km from
+        `place`."""
+        x, y = self.project(place.lon, place.lat)
+        return self.tree.within(x, y, radius)
+
+    def nearest(self, place, k = 1):
+        """Return (distance, place) pairs of the `k` indexed places nearest
+        to `place`, the nearest first."""
+        x, y = self.project(place.lon, place.lat)
+        return self.tree.nearest(x, y, k)
+
+    def grid_radius(self, width, height):
+        """Radius of a circle of the area of a cell of a width×height
+        grid covering the indexed places."""
+        return math.sqrt(self.width * self.height / (width * height) / math.pi)
+
+class Neighbourhood(Cell):
+    """Locations of the indexed places around a place."""
+    def __init__(self, place, radius, places):
+        Cell.__init__(self, place.lon, place.lat)
+        self.radius = radius
+        for p in places:
+            self.add_place(p)
+
+    def __unicode__(self):
+        return u"%.1f km od (%f, %f) (%i województw, %i powiatów, %i gmin)" % (
+                        self.radius, self.x, self.y, len(self.wojewodztwa),
+                                len(self.powiaty), len(self.gminy))
+
+class RadiusGrid(object):
+    """`teryt2osm.grid.Grid` replacement using neighbourhoods of
+    `radius` km."""
+    def __init__(self, index, radius):
+        self.index = index
+        self.radius = radius
+        self._cells = {}
+
+    def get_cell(self, place):
+        cell = self._cells.get(id(place))
+        if cell is None:
+            cell = Neighbourhood(place, self.radius,
+                                    self.index.within(place, self.radius))
+            self._cells[id(place)] = cell
+        return cell
+
+    def get_cells(self, places):
+        return [self.get_cell(place) for place in places]
+
+    def near(self, place, other):
+        """Check if two places are within the radius from each other."""
+        return self.index.distance(place, other) <= self.radius
+
+    def __unicode__(self):
+        return u"%.1f km (%i miejsc)" % (self.radius, len(self.index))
+
+class RadiusGrids(object):
+    """`teryt2osm.grid.GridPyramid` replacement: `RadiusGrid` objects
+    with neighbourhoods of the area of the cells of a grid of given size.
+    The index is built again when places are added."""
+    def __init__(self, places):
+        self.places = list(places)
+        self.place_ids = set([id(p) for p in self.places])
+        self.index = SpatialIndex(self.places)
+
+    def add(self, places):
+        places = [p for p in places if id(p) not in self.place_ids]
+        if places:
+            self.places += places
+            self.place_ids.update([id(p) for p in places])
+            self.index = SpatialIndex(self.places)
+
+    def get(self, width, height):
+        return RadiusGrid(self.index, self.index.grid_radius(width, height))
@@ -24,8 +24,9 @@ __version__ = "$Revision$"
 
 import os
 import xml.etree.cElementTree as ElementTree
-from teryt2osm.utils import add_to_list_dict, count_elements
+from teryt2osm.utils import add_to_list_dict, ProgressFile, iter_elements
 from teryt2osm.reporting import Reporting
+from teryt2osm.snapshot import load_snapshot, save_snapshot
 
 def parse_terc(value, level = "gmina"):
     """Parse TERC or TERC10 code. Level is the administrative unit level 'gmi',
@@ -64,23 +65,58 @@ def parse_terc(value, level = "gmina"):
 
 class TERCObject(object):
     _by_code = {}
+    _units = []
+    _database = None
+    level = None
+    index = None
     name = ""
     woj_code = ""
     pow_code = ""
     gmi_code = ""
     gmi_type = ""
     def register(self):
+        """Add the unit to the indexes and give it `index`, a small
+        integer, unique among the units of the same level."""
         self.__class__._by_code[self.code] = self
         TERCObject._by_code[self.code] = self
+        self.index = len(self.__class__._units)
+        self.__class__._units.append(self)
+    @classmethod
+    def by_index(cls, index):
+        """Return unit of the class with given `index`."""
+        return cls._units[index]
+    @classmethod
+    def use_database(cls, database):
+        """Look up units missing in memory in a
+        `teryt2osm.catalog_db.CatalogDatabase`."""
+        TERCObject._database = database
     @classmethod
     def all(cls):
+        if TERCObject._database is not None:
+            return TERCObject._database.terc_all(cls)
         return cls._by_code.values()
     @classmethod
     def count(cls):
+        if TERCObject._database is not None:
+            return TERCObject._database.terc_count(cls)
         return len(cls._by_code)
     @classmethod
     def by_code(cls, code):
-        return cls._by_code[code]
+        try:
+            return cls._by_code[code]
+        except KeyError:
+            if TERCObject._database is None:
+                raise
+        obj = TERCObject._database.terc_by_code(code)
+        if not isinstance(obj, cls):
+            raise KeyError, code
+        return obj
+    @classmethod
+    def _all_by_name(cls, name):
+        """Return all units of the class with given lower-case name."""
+        if TERCObject._database is not None:
+            return TERCObject._database.terc_by_name(cls, name)
+        return cls._by_name[name]
     @classmethod
     def by_name(cls, name, try_hard = False, wojewodztwo = None, powiat = None):
         raise NotImplementedError, "Not implemented"
@@ -104,7 +140,9 @@ class TERCObject(object):
 
 class Wojewodztwo(TERCObject):
     _by_code = {}
+    _units = []
     _by_name = {}
+    level = "woj"
     def __init__(self, name, woj_code, date):
         self.name = name
         self.date = date
@@ -131,7 +169,9 @@ class Wojewodztwo(TERCObject):
 
 class Powiat(TERCObject):
     _by_code = {}
+    _units = []
     _by_name = {}
+    level = "pow"
     def __init__(self, name, woj_code, pow_code, date):
         self.date = date
         self.woj_code = woj_code
@@ -147,7 +187,7 @@ class Powiat(TERCObject):
 
     @property
     def wojewodztwo(self):
-        woj = Wojewodztwo._by_code[self.woj_code]
+        woj = Wojewodztwo.by_code(self.woj_code)
         self.__dict__['wojewodztwo'] = woj
         return woj
 
@@ -166,7 +206,7 @@ class Powiat(TERCObject):
             name = name.split(None, 1)[1]
         elif not try_hard:
             raise KeyError, name
-        all = cls._by_name[name]
+        all = cls._all_by_name(name)
         if len(all) == 1:
             return all[0]
         if wojewodztwo:
@@ -181,7 +221,9 @@ class Powiat(TERCObject):
 
 class Gmina(TERCObject):
     _by_code = {}
+    _units = []
     _by_name = {}
+    level = "gmi"
     def __init__(self, name, woj_code, pow_code, gmi_code, gmi_type, date):
         if name.startswith("M."):
             self.name = "m." + name[2:]
@@ -197,12 +239,12 @@ class Gmina(TERCObject):
         add_to_list_dict(self._by_name, name.lower(), self)
     @property
     def wojewodztwo(self):
-        woj = Wojewodztwo._by_code[self.woj_code]
+        woj = Wojewodztwo.by_code(self.woj_code)
         self.__dict__['wojewodztwo'] = woj
         return woj
     @property
     def powiat(self):
-        pow = Powiat._by_code[self.woj_code + self.pow_code]
+        pow = Powiat.by_code(self.woj_code + self.pow_code)
         self.__dict__['powiat'] = pow
         return pow
     @classmethod
@@ -213,7 +255,7 @@ class Gmina(TERCObject):
             name = name.split(None, 1)[1]
         elif not try_hard:
             raise KeyError, name
-        all = cls._by_name[name]
+        all = cls._all_by_name(name)
         if len(all) == 1:
             return all[0]
         if powiat:
@@ -252,7 +294,11 @@ class Gmina(TERCObject):
     def __repr__(self):
         return "<Gmina %s %r>" % (self.code, self.full_name())
 
-def load_terc_object(element):
+def parse_terc_row(element):
+    """Extract column values from a TERC.xml row element.
+
+    Return (woj_code, pow_code, gmi_code, gmi_type, name, date) tuple."""
+    woj_code = pow_code = gmi_code = gmi_type = name = date = None
     for child in element:
         if child.tag != 'col':
             continue
@@ -269,6 +315,11 @@ def load_terc_object(element):
             name = child.text
         elif key == "STAN_NA":
             date = child.text
+    return (woj_code, pow_code, gmi_code, gmi_type, name, date)
+
+def load_terc_row(row):
+    """Create TERC object from a row returned by `parse_terc_row`."""
+    woj_code, pow_code, gmi_code, gmi_type, name, date = row
     if gmi_type:
         return Gmina(name, woj_code, pow_code, gmi_code, gmi_type, date)
     elif pow_code:
@@ -285,15 +336,43 @@ def load_terc_object(element):
             name = name[12:].lower()
         return Wojewodztwo(name, woj_code, date)
 
-def load_terc():
+def load_terc_object(element):
+    return load_terc_row(parse_terc_row(element))
+
+def read_terc_rows(filename):
+    """Parse all rows of a TERC file into tuples returned by
+    `parse_terc_row`."""
+    return [parse_terc_row(elem) for elem in iter_elements(filename, "row")]
+
+def load_terc(use_snapshot = True, rows = None, from_snapshot = False):
+    """Load the TERC catalog. If `rows` is given, it should be a result
+    of `read_terc_rows` and the file is not parsed again. `from_snapshot`
+    tells the rows were loaded from the snapshot."""
     reporting = Reporting()
-    row_count = count_elements("data/TERC.xml", "row")
-    reporting.progress_start(u"Ładowanie data/TERC.xml", row_count)
-    for event, elem in ElementTree.iterparse("data/TERC.xml"):
-        if event == 'end' and elem.tag == 'row':
-            load_terc_object(elem)
-            reporting.progress()
-    reporting.progress_stop()
+    if rows is None and use_snapshot:
+        rows = load_snapshot("data/TERC.xml")
+        from_snapshot = rows is not None
+    if rows is not None:
+        if from_snapshot:
+            reporting.output_msg("info", u"Ładowanie data/TERC.xml z kopii podręcznej")
+        for row in rows:
+            load_terc_row(row)
+        if use_snapshot and not from_snapshot:
+            save_snapshot("data/TERC.xml", rows)
+    else:
+        rows = []
+        stream = ProgressFile("data/TERC.xml")
+        try:
+            reporting.progress_start(u"Ładowanie data/TERC.xml", stream.size)
+            for elem in iter_elements(stream, "row"):
+                row = parse_terc_row(elem)
+                load_terc_row(row)
+                rows.append(row)
+            reporting.progress_stop()
+        finally:
+            stream.close()
+        if use_snapshot:
+            save_snapshot("data/TERC.xml", rows)
     reporting.output_msg("stats", u"Załadowano %i województw, %i powiatów i %i gmin" % (
             Wojewodztwo.count(), Powiat.count(), Gmina.count()))
 
@@ -20,8 +20,9 @@
 
 __version__ = "$Revision$"
 
-import subprocess
+import os
 import sys
+import xml.etree.cElementTree as ElementTree
 
 def setup_locale():
     """Set up locale and sys.stdout, sys.stderr streams so Unicode output will
@@ -34,6 +35,19 @@ def setup_locale():
     sys.stdout = codecs.getwriter(encoding)(sys.stdout, errors = "replace")
     sys.stderr = codecs.getwriter(encoding)(sys.stderr, errors = "replace")
 
+_strings = {}
+
+def intern_string(value):
+    """Return a shared instance of a string equal to `value`.
+
+    Unlike the `intern` builtin this works for unicode strings too.
+    The strings are never released, so this is used only for values from
+    small sets, repeated in many objects (tag keys, place types, versions,
+    dates, codes). Mostly unique values, like names, must not be interned."""
+    if value is None:
+        return None
+    return _strings.setdefault(value, value)
+
 def add_to_list_dict(dictionary, key, value):
     """Add a value to a dictionary keeping list of values for a key.
     Create the list if it doesn't exist yet."""
@@ -42,11 +56,157 @@ def add_to_list_dict(dictionary, key, value):
     else:
         dictionary[key] = [value]
 
-def count_elements(filename, tag):
-    """Simple hack to quickly count elements in a XML file."""
-    popen = subprocess.Popen(["grep", "-c", "<" + tag, filename],
-                                                stdout=subprocess.PIPE)
-    (stdout, stderr) = popen.communicate()
-    tag_count = int(stdout.strip())
-    return tag_count
+def iter_elements(source, tag):
+    """Iterate over all `tag` elements of an XML file, releasing them
+    after they have been processed. `tag` may also be a tuple of tag
+    names.
+
+    Each element is complete (with all its children) when yielded and
+    is cleared and detached from its parent when the iteration continues.
+    Other elements are released as soon as they are complete, unless they
+    are a part of a `tag` element, so the memory used does not grow with
+    the size of the document. The caller must not keep references to the
+    yielded elements."""
+    if isinstance(tag, basestring):
+        tags = (tag,)
+    else:
+        tags = tag
+    stack = []
+    open_count = 0
+    for event, elem in ElementTree.iterparse(source, ("start", "end")):
+        if event == "start":
+            stack.append(elem)
+            if elem.tag in tags:
+                open_count += 1
+            continue
+        stack.pop()
+        if elem.tag in tags:
+            open_count -= 1
+            yield elem
+        elif open_count:
+            # a part of the `tag` element being read
+            continue
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+def _find_start_tag(stream, tag, position):
+    """Find the first `tag` start tag at or after `position`.
+    Return its offset or `None` if not found."""
+    pattern = "<" + tag
+    stream.seek(position)
+    buf = ""
+    buf_start = position
+    while True:
+        data = stream.read(65536)
+        if not data:
+            return None
+        buf += data
+        index = buf.find(pattern)
+        while index >= 0:
+            next_char = buf[index + len(pattern):index + len(pattern) + 1]
+            if not next_char:
+                # need more data to decide
+                break
+            if next_char in "> \t\r\n/":
+                return buf_start + index
+            index = buf.find(pattern, index + 1)
+        if index >= 0:
+            keep = index
+        else:
+            keep = max(len(buf) - len(pattern), 0)
+        buf_start += keep
+        buf = buf[keep:]
+
+def split_xml(filename, tag, parts):
+    """Split an XML file into byte ranges containing only complete
+    `tag` elements (which must not be nested).
+
+    Return list of (start, end) offsets. The content between the ranges
+    (the document header and footer) is not included in any range."""
+    stream = open(filename, "rb")
+    try:
+        stream.seek(0, 2)
+        size = stream.tell()
+        first = _find_start_tag(stream, tag, 0)
+        if first is None:
+            return []
+        end_tag = "</" + tag + ">"
+        tail_start = max(size - 65536, first)
+        while True:
+            stream.seek(tail_start)
+            tail = stream.read(size - tail_start)
+            index = tail.rfind(end_tag)
+            if index >= 0:
+                last = tail_start + index + len(end_tag)
+                break
+            if tail_start == first:
+                return []
+            tail_start = max(tail_start - 65536, first)
+        boundaries = [first]
+        for i in range(1, parts):
+            position = first + (last - first) * i / parts
+            if position <= boundaries[-1]:
+                continue
+            start = _find_start_tag(stream, tag, position)
+            if start is None or start >= last:
+                break
+            if start > boundaries[-1]:
+                boundaries.append(start)
+        boundaries.append(last)
+    finally:
+        stream.close()
+    return zip(boundaries[:-1], boundaries[1:])
+
+def read_xml_range(filename, start, end):
+    """Read a byte range returned by `split_xml` as a file-like object
+    containing a complete XML document."""
+    from cStringIO import StringIO
+    stream = open(filename, "rb")
+    try:
+        header = stream.read(1024)
+        if header.startswith("<?xml") and "?>" in header:
+            header = header[:header.index("?>") + 2]
+        else:
+            header = ""
+        stream.seek(start)
+        data = stream.read(end - start)
+    finally:
+        stream.close()
+    return StringIO(header + "<chunk>" + data + "</chunk>")
+
+
+class ProgressFile(object):
+    """Read-only file object reporting the number of bytes consumed
+    as the progress.
+
+    Usage::
+
+        stream = ProgressFile(filename)
+        try:
+            reporting.progress_start(msg, stream.size)
+            for event, elem in ElementTree.iterparse(stream):
+                ...
+            reporting.progress_stop()
+        finally:
+            stream.close()
+
+    This way the file is read only once, no elements need to be counted
+    in advance."""
+    def __init__(self, filename):
+        from teryt2osm.reporting import Reporting
+        self.reporting = Reporting()
+        self.name = filename
+        self.file = open(filename, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def read(self, size = -1):
+        data = self.file.read(size)
+        self.reporting.progress(len(data))
+        return data
+
+    def tell(self):
+        return self.file.tell()
 
+    def close(self):
+        self.file.close()
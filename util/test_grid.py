@@ -0,0 +1,55 @@
+#!/usr/bin/python
+
+import random
+import time
+
+from teryt2osm.utils import setup_locale
+from teryt2osm.grid import Grid, bounding_box, HAVE_NUMPY
+
+class Location(object):
+    def __init__(self, index):
+        self.index = index
+
+class Place(object):
+    def __init__(self, lat, lon, wojewodztwo, powiat, gmina):
+        self.lat = lat
+        self.lon = lon
+        self.wojewodztwo = wojewodztwo
+        self.powiat = powiat
+        self.gmina = gmina
+
+def counts(grid):
+    result = {}
+    for key, cell in grid.cells.items():
+        result[key] = [dict(zip(s.indices, s.counts))
+                    for s in (cell.wojewodztwa, cell.powiaty, cell.gminy)]
+    return result
+
+setup_locale()
+random.seed(1)
+wojewodztwa = [Location(i) for i in range(16)]
+powiaty = [Location(i) for i in range(380)]
+gminy = [Location(i) for i in range(2500)]
+places = []
+for i in range(100000):
+    gmi = random.randrange(len(gminy))
+    places.append(Place(random.uniform(49, 55), random.uniform(14, 24.5),
+                random.choice([None, wojewodztwa[gmi % len(wojewodztwa)]]),
+                            powiaty[gmi % len(powiaty)],
+                            random.choice([None, gminy[gmi]])))
+bbox = bounding_box(places)
+
+loop = Grid([], 43, 43, bbox)
+start = time.time()
+for place in places:
+    loop.add_place(place)
+print "loop: %.3fs" % (time.time() - start,)
+
+batch = Grid([], 43, 43, bbox)
+start = time.time()
+batch._add_places_batch(places)
+print "batch (NumPy: %r): %.3fs" % (HAVE_NUMPY, time.time() - start)
+
+print "same counts:", counts(loop) == counts(batch)
+print "same cells:", ([(c.x, c.y) for c in loop.get_cells(places)]
+                    == [batch.cell_index(place) for place in places])